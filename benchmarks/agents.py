@@ -0,0 +1,136 @@
+"""
+Runs every agent of main.AGENTS with its buffer from main.BUFFERS on CartPole-v1 for a fixed number of
+training steps and reports env steps/sec, gradient steps/sec, peak memory and time to a reward threshold.
+Results are stored in benchmarks/results/<commit>.json to be compared across commits.
+Run from the repository root:
+    python -m benchmarks.agents
+    python -m benchmarks.agents --compare benchmarks/results/<old>.json benchmarks/results/<new>.json
+"""
+import os
+
+os.environ['TF_CPP_MIN_LOG_LEVEL'] = '3'  # to disable tf messages
+
+import argparse
+import datetime
+import json
+import multiprocessing
+import subprocess
+import time
+
+RESULTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "results")
+METRICS = ("env_steps_per_sec", "gradient_steps_per_sec", "peak_rss_mb", "time_to_threshold", "final_reward")
+
+
+def run_agent(agent_name, env_name, iterations_number, reward_threshold, seed, batch_size=64, n_steps=2):
+    import random
+
+    import numpy as np
+    import tensorflow as tf
+
+    import main
+
+    random.seed(seed)
+    np.random.seed(seed)
+    tf.random.set_seed(seed)
+
+    start_time = time.perf_counter()
+    buffer = main.BUFFERS[agent_name](min_size=batch_size)
+    agent = main.AGENTS[agent_name](env_name,
+                                    buffer.table_name, buffer.server_port, buffer.min_size,
+                                    n_steps,
+                                    None, False,
+                                    seed=seed)
+    startup_time = time.perf_counter() - start_time
+    _, _, reward = agent.train(iterations_number=iterations_number)
+    statistics = agent.get_statistics()
+
+    times, counters = statistics["times"], statistics["counters"]
+    training_time = times.get("sampling", 0.) + times.get("training_step", 0.) + \
+        times.get("fused_sampling_and_training", 0.)
+    reached = [elapsed for _, mean_reward, elapsed in statistics["evaluations"] if mean_reward >= reward_threshold]
+    return {
+        "env_steps_per_sec": counters.get("env_steps", 0) / times["collection"],
+        "gradient_steps_per_sec": counters.get("gradient_steps", 0) / training_time,
+        "peak_rss_mb": statistics["peak_rss"] / 2 ** 20,
+        "time_to_threshold": reached[0] if reached else None,
+        "final_reward": float(reward),
+        "startup_time": startup_time,
+        "elapsed": statistics["elapsed"],
+        "times": times,
+        "counters": counters,
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def run(agent_names=None, env_name='CartPole-v1', iterations_number=2000, reward_threshold=195., seed=0):
+    import main
+
+    agent_names = agent_names or list(main.AGENTS)
+    results = {"commit": git_commit(),
+               "date": datetime.datetime.now().isoformat(timespec="seconds"),
+               "env_name": env_name,
+               "iterations_number": iterations_number,
+               "reward_threshold": reward_threshold,
+               "seed": seed,
+               "agents": {}}
+    # every agent runs in a new process to measure its own memory and to not share a tf state
+    context = multiprocessing.get_context("spawn")
+    for agent_name in agent_names:
+        with context.Pool(1) as pool:
+            try:
+                results["agents"][agent_name] = pool.apply(
+                    run_agent, (agent_name, env_name, iterations_number, reward_threshold, seed))
+            except Exception as error:
+                results["agents"][agent_name] = {"error": repr(error)}
+        print(agent_name, _format_metrics(results["agents"][agent_name]))
+
+    os.makedirs(RESULTS_DIR, exist_ok=True)
+    path = os.path.join(RESULTS_DIR, f"{results['commit']}.json")
+    with open(path, "w") as f:
+        json.dump(results, f, indent=2)
+    print(f"Results are stored in {path}")
+    return results
+
+
+def _format_metrics(result):
+    if "error" in result:
+        return result["error"]
+    return ", ".join(f"{metric}: {result[metric]:.2f}" if result[metric] is not None else f"{metric}: -"
+                     for metric in METRICS)
+
+
+def compare(old_path, new_path):
+    with open(old_path) as f:
+        old = json.load(f)
+    with open(new_path) as f:
+        new = json.load(f)
+    print(f"{old['commit']} -> {new['commit']}, new / old ratios")
+    print(f"{'agent':22s}" + "".join(f"{metric:>24s}" for metric in METRICS))
+    for agent_name in new["agents"]:
+        old_result, new_result = old["agents"].get(agent_name, {}), new["agents"][agent_name]
+        line = f"{agent_name:22s}"
+        for metric in METRICS:
+            old_value, new_value = old_result.get(metric), new_result.get(metric)
+            line += f"{new_value / old_value:24.2f}" if old_value and new_value is not None else f"{'-':>24s}"
+        print(line)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--agents", nargs="*", help="names from main.AGENTS, all by default")
+    parser.add_argument("--iterations", type=int, default=2000)
+    parser.add_argument("--threshold", type=float, default=195.)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--compare", nargs=2, metavar=("OLD", "NEW"))
+    args = parser.parse_args()
+
+    if args.compare:
+        compare(*args.compare)
+    else:
+        run(args.agents, iterations_number=args.iterations, reward_threshold=args.threshold, seed=args.seed)
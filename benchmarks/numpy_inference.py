@@ -0,0 +1,44 @@
+"""
+Compares per step action selection of an agent compiled policy with numpy_inference policies
+(float32 and int8 kernels): latency for one observation and a share of the same greedy actions.
+Run from the repository root: python -m benchmarks.numpy_inference
+"""
+import os
+
+os.environ['TF_CPP_MIN_LOG_LEVEL'] = '3'  # to disable tf messages
+
+import timeit
+
+import numpy as np
+
+AGENT_NAMES = ("regular", "double_dueling", "categorical", "actor_critic")
+
+
+def run(agent_names=AGENT_NAMES, env_name='CartPole-v1', batch_size=64, number=1000, n_observations=1000):
+    import main
+
+    print(f"{'agent':16s}{'tf, us':>10s}{'numpy, us':>12s}{'int8, us':>12s}{'same, %':>10s}{'int8 same, %':>14s}")
+    for agent_name in agent_names:
+        buffer = main.BUFFERS[agent_name](min_size=batch_size)
+        agent = main.AGENTS[agent_name](env_name,
+                                        buffer.table_name, buffer.server_port, buffer.min_size,
+                                        2,
+                                        None, False)
+        policy = agent.export_policy()
+        quantized_policy = agent.export_policy(quantize=True)
+        observations = np.stack([agent._eval_env.observation_space.sample()
+                                 for _ in range(n_observations)]).astype(np.float32)
+        obs = observations[0]
+
+        tf_time = timeit.timeit(lambda: agent._epsilon_greedy_policy(obs, 0), number=number) / number
+        numpy_time = timeit.timeit(lambda: policy.act(obs), number=number) / number
+        int8_time = timeit.timeit(lambda: quantized_policy.act(obs), number=number) / number
+        tf_actions = agent._epsilon_greedy_policy_batch(observations, 0)
+        same = np.mean(policy(observations) == tf_actions)
+        int8_same = np.mean(quantized_policy(observations) == tf_actions)
+        print(f"{agent_name:16s}{tf_time * 1e6:10.1f}{numpy_time * 1e6:12.1f}{int8_time * 1e6:12.1f}"
+              f"{same * 100:10.1f}{int8_same * 100:14.1f}")
+
+
+if __name__ == '__main__':
+    run()
@@ -0,0 +1,57 @@
+"""
+Checks that misc.project_distribution_linear matches misc.project_distribution
+and compares their speed for several numbers of atoms.
+Run from the repository root: python -m benchmarks.projection
+"""
+import os
+
+os.environ['TF_CPP_MIN_LOG_LEVEL'] = '3'  # to disable tf messages
+
+import timeit
+
+import numpy as np
+import tensorflow as tf
+
+from tf_reinforcement_testcases import misc
+
+
+def make_inputs(batch_size, n_atoms, seed=0):
+    """
+    Inputs as in CategoricalDQNAgent._training_step: shifted and scaled supports with softmax weights
+    """
+    rng = np.random.default_rng(seed)
+    target_support = tf.cast(tf.linspace(0., 51., n_atoms), tf.float32)
+    rewards = rng.uniform(-5., 5., size=(batch_size, 1))
+    gammas = rng.choice([0., 0.95, 0.95 ** 2], size=(batch_size, 1))
+    supports = tf.constant(rewards + gammas * target_support.numpy()[None, :], dtype=tf.float32)
+    logits = rng.normal(size=(batch_size, n_atoms))
+    weights = tf.nn.softmax(tf.constant(logits, dtype=tf.float32))
+    return supports, weights, target_support
+
+
+def check_equivalence(batch_size=64, atoms=(5, 51, 201), atol=1e-5):
+    for n_atoms in atoms:
+        supports, weights, target_support = make_inputs(batch_size, n_atoms)
+        tiled = misc.project_distribution(supports, weights, target_support)
+        linear = misc.project_distribution_linear(supports, weights, target_support)
+        max_difference = np.max(np.abs(tiled.numpy() - linear.numpy()))
+        assert max_difference < atol, f"{n_atoms} atoms: projections differ by {max_difference}"
+        print(f"{n_atoms} atoms: max abs difference {max_difference:.2e}")
+
+
+def run(batch_size=64, atoms=(51, 201, 501), number=100):
+    print(f"batch size: {batch_size}, time per call in ms")
+    for n_atoms in atoms:
+        inputs = make_inputs(batch_size, n_atoms)
+        line = f"{n_atoms:4d} atoms:"
+        for name, function in misc.PROJECTIONS.items():
+            compiled = tf.function(function)
+            compiled(*inputs)
+            elapsed = timeit.timeit(lambda: compiled(*inputs).numpy(), number=number) / number
+            line += f"  {name} {elapsed * 1e3:8.3f}"
+        print(line)
+
+
+if __name__ == '__main__':
+    check_equivalence()
+    run()
@@ -0,0 +1,50 @@
+"""
+Measures how many items per second storage.initialize_dataset yields
+for several sampling settings, to size the input pipeline for a number of cores,
+and for an in-process local_buffer.
+Run from the repository root: python -m benchmarks.replay_dataset
+"""
+import os
+
+os.environ['TF_CPP_MIN_LOG_LEVEL'] = '3'  # to disable tf messages
+
+import numpy as np
+
+from tf_reinforcement_testcases import storage, local_buffer
+
+
+def fill_buffer(buffer, observation_shape, n_steps, n_episodes=100, episode_length=200):
+    client = storage.make_client(buffer.server_port)
+    episode_buffer = storage.EpisodeBuffer()
+    for _ in range(n_episodes):
+        episode_buffer.reset(np.random.random(observation_shape))
+        for step in range(episode_length):
+            episode_buffer.append(np.random.randint(4), np.random.random(observation_shape),
+                                  1., step == episode_length - 1)
+        with client.writer(max_sequence_length=n_steps) as writer:
+            episode_buffer.write(writer, buffer.table_name, n_steps)
+
+
+def run(observation_shape=(4,), batch_size=64, n_steps=2,
+        settings=({"num_parallel_calls": 1, "prefetch": 0},
+                  {"num_parallel_calls": 1},
+                  {"num_parallel_calls": 2},
+                  {"num_parallel_calls": 4},
+                  {"num_parallel_calls": 4, "max_in_flight_samples_per_worker": 100})):
+    buffer = storage.UniformBuffer(min_size=batch_size)
+    fill_buffer(buffer, observation_shape, n_steps)
+    print(f"observation shape: {observation_shape}, batch size: {batch_size}, n_steps: {n_steps}")
+    for parameters in settings:
+        dataset = storage.initialize_dataset(buffer.server_port, buffer.table_name, observation_shape,
+                                             batch_size, n_steps, **parameters)
+        print(f"{parameters}: {storage.dataset_throughput(dataset):.0f} items/sec")
+
+    buffer = local_buffer.UniformBuffer(min_size=batch_size)
+    fill_buffer(buffer, observation_shape, n_steps)
+    dataset = storage.initialize_dataset(buffer.server_port, buffer.table_name, observation_shape,
+                                         batch_size, n_steps)
+    print(f"local buffer: {storage.dataset_throughput(dataset):.0f} items/sec")
+
+
+if __name__ == '__main__':
+    run()
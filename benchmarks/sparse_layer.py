@@ -0,0 +1,133 @@
+"""
+Compares forward and training step time of sparse MLPs from models.get_sparse
+with the previous implementation, which ran one masked matmul per output neuron.
+Run from the repository root: python -m benchmarks.sparse_layer
+"""
+import os
+
+os.environ['TF_CPP_MIN_LOG_LEVEL'] = '3'  # to disable tf messages
+
+import timeit
+from abc import ABC
+
+import numpy as np
+import tensorflow as tf
+from tensorflow import keras
+
+from tf_reinforcement_testcases import models
+
+
+def get_per_neuron_sparse(weights_in, mask_in):
+    """
+    The previous get_sparse implementation, kept here as a reference point
+    """
+
+    class SparseSublayer(keras.layers.Layer):
+        def __init__(self, w_init):
+            super(SparseSublayer, self).__init__()
+            self._w = tf.Variable(initial_value=w_init, trainable=True, dtype=tf.float32)
+
+        def call(self, inputs, **kwargs):
+            return tf.matmul(inputs, self._w)
+
+    class SparseLayer(keras.layers.Layer):
+        def __init__(self, w_init, b_init, mask):
+            super(SparseLayer, self).__init__()
+            bool_mask = mask.astype(bool)
+            self._w = []
+            self._mask = []
+            self._num_connections = []
+            num_neurons = self._num_neurons = w_init.shape[-1]
+            for i in range(num_neurons):
+                masked_weights_column = w_init[:, i][bool_mask[:, i]][..., None]
+                self._w.append(SparseSublayer(masked_weights_column))
+                self._mask.append(tf.constant(bool_mask[:, i], dtype=tf.bool))
+                self._num_connections.append(tf.constant(np.sum(mask[:, i]).astype(np.int32), dtype=tf.int32))
+            self._b = tf.Variable(initial_value=b_init, trainable=True, dtype=tf.float32)
+
+        def call(self, inputs, **kwargs):
+            neurons = []
+            for i in range(self._num_neurons):
+                mask = tf.broadcast_to(self._mask[i], [inputs.shape[0], self._mask[i].shape[0]])
+                masked_inputs = tf.boolean_mask(inputs, mask)
+                reshaped_masked_inputs = tf.reshape(masked_inputs, [inputs.shape[0], self._num_connections[i]])
+                neurons.append(self._w[i](reshaped_masked_inputs) + self._b[i])
+            return tf.stack(neurons, axis=1)[..., 0]
+
+    class SparseMLP(keras.Model, ABC):
+        def __init__(self, weights, mask):
+            super(SparseMLP, self).__init__()
+            number_of_layers = int(len(weights) / 2)
+            self._main_layers = []
+            for i in range(0, number_of_layers):
+                self._main_layers.append(SparseLayer(weights[i * 2], weights[i * 2 + 1], mask[i * 2]))
+                if i != number_of_layers - 1:
+                    self._main_layers.append(keras.layers.Activation("relu"))
+
+        def call(self, inputs, **kwargs):
+            Z = inputs
+            for layer in self._main_layers:
+                Z = layer(Z)
+            return Z
+
+    return SparseMLP(weights_in, mask_in)
+
+
+def make_data(layer_sizes, density, seed=0):
+    """
+    Random weights and masks in the format of the pickled data: [w0, b0, w1, b1, ...]
+    """
+    rng = np.random.default_rng(seed)
+    weights, mask = [], []
+    for n_in, n_out in zip(layer_sizes[:-1], layer_sizes[1:]):
+        w = rng.uniform(-0.03, 0.03, size=(n_in, n_out)).astype(np.float32)
+        b = np.zeros(n_out, dtype=np.float32)
+        w_mask = (rng.random((n_in, n_out)) < density).astype(np.float32)
+        # keep at least one connection per neuron, the per neuron implementation needs it
+        w_mask[rng.integers(n_in, size=n_out), np.arange(n_out)] = 1.
+        weights += [w, b]
+        mask += [w_mask, np.ones_like(b)]
+    return weights, mask
+
+
+def time_model(model, inputs, number):
+    optimizer = keras.optimizers.Adam()
+
+    @tf.function
+    def forward(x):
+        return model(x)
+
+    @tf.function
+    def train_step(x):
+        with tf.GradientTape() as tape:
+            loss = tf.reduce_mean(tf.square(model(x)))
+        grads = tape.gradient(loss, model.trainable_variables)
+        optimizer.apply_gradients(zip(grads, model.trainable_variables))
+
+    # trace and warm up
+    forward(inputs)
+    train_step(inputs)
+    forward_time = timeit.timeit(lambda: forward(inputs).numpy(), number=number) / number
+    train_time = timeit.timeit(lambda: train_step(inputs), number=number) / number
+    return forward_time, train_time
+
+
+def run(layer_sizes=(4, 500, 500, 2), densities=(0.5, 0.2, 0.1, 0.05, 0.01), batch_size=64, number=50):
+    inputs = tf.random.normal([batch_size, layer_sizes[0]])
+    implementations = {
+        "per_neuron": get_per_neuron_sparse,
+        "masked_dense": models.get_sparse,
+        "coo": lambda weights, mask: models.get_sparse(weights, mask, sparse_matmul=True),
+    }
+    print(f"layers: {layer_sizes}, batch size: {batch_size}, time per call in ms (forward / train step)")
+    for density in densities:
+        weights, mask = make_data(layer_sizes, density)
+        line = f"density {density:5.2f}:"
+        for name, get_model in implementations.items():
+            forward_time, train_time = time_model(get_model(weights, mask), inputs, number)
+            line += f"  {name} {forward_time * 1e3:8.3f} / {train_time * 1e3:8.3f}"
+        print(line)
+
+
+if __name__ == '__main__':
+    run()
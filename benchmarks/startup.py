@@ -0,0 +1,53 @@
+"""
+Measures startup costs of workers: import times of modules in a new process
+and times to get actors ready, made from scratch and reset from a warm pool of main.get_actor_pool().
+Run from the repository root: python -m benchmarks.startup
+"""
+import os
+
+os.environ['TF_CPP_MIN_LOG_LEVEL'] = '3'  # to disable tf messages
+
+import subprocess
+import sys
+import time
+
+MODULES = ("tensorflow", "reverb", "gym", "ray",
+           "tf_reinforcement_testcases.misc", "tf_reinforcement_testcases.deep_q_learning", "main")
+
+
+def import_time(module):
+    # every module is imported in a new process to not measure cached imports
+    code = f"import time; start_time = time.perf_counter(); import {module}; print(time.perf_counter() - start_time)"
+    output = subprocess.check_output([sys.executable, "-c", code], stderr=subprocess.DEVNULL, text=True)
+    return float(output.split()[-1])
+
+
+def actors_startup_time(env_name='CartPole-v1', agent_name='double', n_actors=4, n_calls=3):
+    import ray
+
+    import main
+
+    ray.init(ignore_reinit_error=True)
+    times = []
+    for _ in range(n_calls):
+        start_time = time.perf_counter()
+        _, agents = main.get_actor_pool(env_name, agent_name, None, n_actors)
+        ray.get([agent.get_weights.remote() for agent in agents])
+        times.append(time.perf_counter() - start_time)
+        # trace training functions, as a multi_call does
+        ray.get([agent.train.remote(iterations_number=10) for agent in agents])
+    main.reset_actor_pools()
+    ray.shutdown()
+    return times
+
+
+def run():
+    print("import time in s")
+    for module in MODULES:
+        print(f"{module:45s}{import_time(module):8.2f}")
+    cold, *warm = actors_startup_time()
+    print(f"actors made from scratch: {cold:.2f} s, reset from a pool: {', '.join(f'{t:.2f}' for t in warm)} s")
+
+
+if __name__ == '__main__':
+    run()
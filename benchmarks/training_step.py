@@ -0,0 +1,52 @@
+"""
+Times a training step of every agent on CartPole with XLA compilation and mixed precision switched on and off.
+Run from the repository root: python -m benchmarks.training_step
+"""
+import os
+
+os.environ['TF_CPP_MIN_LOG_LEVEL'] = '3'  # to disable tf messages
+
+import multiprocessing
+import timeit
+
+AGENT_NAMES = ("regular", "fixed", "double", "double_dueling", "categorical", "actor_critic")
+
+CONFIGS = {"float32": {},
+           "xla": {"jit_compile": True},
+           "bfloat16": {"mixed_precision": True},
+           "xla_bfloat16": {"jit_compile": True, "mixed_precision": True}}
+
+
+def time_training_step(agent_name, parameters, env_name='CartPole-v1', batch_size=64, number=200):
+    import main
+
+    buffer = main.BUFFERS[agent_name](min_size=batch_size)
+    agent = main.AGENTS[agent_name](env_name,
+                                    buffer.table_name, buffer.server_port, buffer.min_size,
+                                    2,
+                                    None, False,
+                                    **parameters)
+    # the same batch is used for all steps, so only a training step is timed
+    sample = next(agent._iterator)
+    experiences, info = sample.data, sample.info
+    # trace and compile
+    agent._training_step(*experiences, info=info)
+    return timeit.timeit(lambda: agent._training_step(*experiences, info=info), number=number) / number
+
+
+def run(agent_names=AGENT_NAMES, configs=CONFIGS):
+    # every configuration runs in a new process, so graphs, XLA clusters and memory of previous ones do not skew it
+    context = multiprocessing.get_context("spawn")
+    print("time per training step in ms")
+    print(f"{'agent':16s}" + "".join(f"{name:>14s}" for name in configs))
+    for agent_name in agent_names:
+        line = f"{agent_name:16s}"
+        for parameters in configs.values():
+            with context.Pool(1) as pool:
+                step_time = pool.apply(time_training_step, (agent_name, parameters))
+            line += f"{step_time * 1e3:14.3f}"
+        print(line)
+
+
+if __name__ == '__main__':
+    run()
@@ -2,12 +2,15 @@ import os
 
 os.environ['TF_CPP_MIN_LOG_LEVEL'] = '3'  # to disable tf messages
 
+import json
 import pickle
+import random
+import time
 
 import ray
 import numpy as np
 
-from tf_reinforcement_testcases import deep_q_learning, actor_critic, storage, misc
+from tf_reinforcement_testcases import deep_q_learning, actor_critic, storage, local_buffer, misc, sweep, models
 
 AGENTS = {"regular": deep_q_learning.RegularDQNAgent,
           "fixed": deep_q_learning.FixedQValuesDQNAgent,
@@ -25,42 +28,115 @@ BUFFERS = {"regular": storage.UniformBuffer,
            "priority_categorical": storage.PriorityBuffer,
            "actor_critic": storage.UniformBuffer}
 
+# in-process buffers for single process runs, see local_buffer
+LOCAL_BUFFERS = {"regular": local_buffer.UniformBuffer,
+                 "fixed": local_buffer.UniformBuffer,
+                 "double": local_buffer.UniformBuffer,
+                 "double_dueling": local_buffer.UniformBuffer,
+                 "categorical": local_buffer.UniformBuffer,
+                 "priority_categorical": local_buffer.PriorityBuffer,
+                 "actor_critic": local_buffer.UniformBuffer}
 
-def one_call(env_name, agent_name, data, make_sparse):
+
+def one_call(env_name, agent_name, data, make_sparse, checkpoint_dir=None, buffer_checkpoint_path=None,
+             local=False):
+    """
+    checkpoint_dir, e.g. 'data/checkpoints', makes training resumable after it is interrupted:
+    a resumed run trains up to 2000 steps in total, counting restored steps, and a finished one only evaluates;
+    buffer_checkpoint_path, e.g. 'data/buffer', keeps a buffer snapshot, so next runs skip warm-up collection,
+    a resumed run without it collects warm-up episodes again;
+    if local, a buffer is kept in the process (LOCAL_BUFFERS) instead of a reverb server
+    """
     batch_size = 64
     n_steps = 2
-    buffer = BUFFERS[agent_name](min_size=batch_size)
+    buffers = LOCAL_BUFFERS if local else BUFFERS
+    buffer = buffers[agent_name](min_size=batch_size, checkpoint_path=buffer_checkpoint_path)
 
     agent_object = AGENTS[agent_name]
     agent = agent_object(env_name,
                          buffer.table_name, buffer.server_port, buffer.min_size,
                          n_steps,
-                         data, make_sparse)
+                         data, make_sparse,
+                         checkpoint_dir=checkpoint_dir)
     weights, mask, reward = agent.train(iterations_number=2000)
+    if buffer_checkpoint_path:
+        print(f"Buffer snapshot: {buffer.checkpoint()}")
 
     data = {
         'weights': weights,
         'mask': mask,
-        'reward': reward
+        'reward': reward,
+        'hidden_units': data.get('hidden_units') if data else None
     }
     with open('data/data.pickle', 'wb') as f:
         pickle.dump(data, f, pickle.HIGHEST_PROTOCOL)
     print("Done")
 
 
-def multi_call(env_name, agent_name, data, make_sparse, plot=False):
-    ray.init()
-    parallel_calls = 10
-    batch_size = 64
-    n_steps = 2
-    buffer = BUFFERS[agent_name](min_size=batch_size)
+# warm agent actors, which are reused by successive multi_call calls:
+# (env_name, agent_name, number of actors, hidden units) -> (buffer, actors)
+ACTOR_POOLS = {}
+
 
+def make_actors(env_name, agent_name, data, make_sparse, n_actors, batch_size=64, n_steps=2):
+    buffer = BUFFERS[agent_name](min_size=batch_size)
     agent_object = AGENTS[agent_name]
     agent_object = ray.remote(agent_object)
     agents = [agent_object.remote(env_name,
                                   buffer.table_name, buffer.server_port, buffer.min_size,
                                   n_steps,
-                                  data, make_sparse) for _ in range(parallel_calls)]
+                                  data, make_sparse) for _ in range(n_actors)]
+    return buffer, agents
+
+
+def get_actor_pool(env_name, agent_name, data, n_actors):
+    """
+    Returns a buffer and actors of a pool, actors of an existing pool are reset to data weights
+    or to new random weights; they keep environments and traced functions,
+    a buffer is cleared and actors collect warm-up episodes again, so a call does not train on previous experience
+    """
+    # models of pruned data have other sizes
+    key = (env_name, agent_name, n_actors, tuple(data.get('hidden_units') or ()) if data else ())
+    if key in ACTOR_POOLS:
+        buffer, agents = ACTOR_POOLS[key]
+        storage.make_client(buffer.server_port).reset(buffer.table_name)
+        weights = data['weights'] if data else None
+        ray.get([agent.reset.remote(weights) for agent in agents])
+    else:
+        ACTOR_POOLS[key] = make_actors(env_name, agent_name, data, False, n_actors)
+    return ACTOR_POOLS[key]
+
+
+def reset_actor_pools():
+    """
+    Stops actors of all pools, e.g. to free resources or to pick up code changes
+    """
+    for _, agents in ACTOR_POOLS.values():
+        for agent in agents:
+            ray.kill(agent)
+    ACTOR_POOLS.clear()
+
+
+def multi_call(env_name, agent_name, data, make_sparse, plot=False, reuse_actors=True):
+    """
+    If reuse_actors, actors are taken from a warm pool, which is kept after the call, see get_actor_pool();
+    sparse models depend on a mask of data, so actors are made anew for them
+    """
+    ray.init(ignore_reinit_error=True)
+    parallel_calls = 10
+    batch_size = 64
+    n_steps = 2
+
+    start_time = time.perf_counter()
+    is_pooled = reuse_actors and not make_sparse
+    if is_pooled:
+        buffer, agents = get_actor_pool(env_name, agent_name, data, parallel_calls)
+    else:
+        buffer, agents = make_actors(env_name, agent_name, data, make_sparse, parallel_calls, batch_size, n_steps)
+    # wait for actors to be made or reset
+    ray.get([agent.get_weights.remote() for agent in agents])
+    print(f"Actors startup time: {time.perf_counter() - start_time:.1f} s")
+
     futures = [agent.train.remote(iterations_number=2000) for agent in agents]
     outputs = ray.get(futures)
 
@@ -78,15 +154,190 @@ def multi_call(env_name, agent_name, data, make_sparse, plot=False):
     data = {
         'weights': weights_list[argmax],
         'mask': mask_list[argmax],
-        'reward': rewards[argmax]
+        'reward': rewards[argmax],
+        'hidden_units': data.get('hidden_units') if data else None
+    }
+    with open('data/data.pickle', 'wb') as f:
+        pickle.dump(data, f, pickle.HIGHEST_PROTOCOL)
+
+    if not is_pooled:
+        for agent in agents:
+            ray.kill(agent)
+    print("Done")
+
+
+def apex_call(env_name, agent_name, data, make_sparse,
+              n_collectors=8, n_rounds=200, learner_steps=10, max_staleness=2,
+              collect_episodes=1, n_collect_envs=1):
+    """
+    Ape-X like topology: many collector actors fill a shared buffer, one learner trains on it.
+    Every learner_steps training steps the learner publishes a new weights version,
+    collectors pick the latest version up with their next collection task;
+    the learner waits for collectors running on weights older than max_staleness versions.
+    """
+    ray.init(ignore_reinit_error=True)
+    batch_size = 64
+    n_steps = 2
+    buffer = BUFFERS[agent_name](min_size=batch_size)
+
+    agent_object = AGENTS[agent_name]
+    agent_object = ray.remote(agent_object)
+    learner = agent_object.remote(env_name,
+                                  buffer.table_name, buffer.server_port, buffer.min_size,
+                                  n_steps,
+                                  data, make_sparse)
+    collectors = [agent_object.remote(env_name,
+                                      buffer.table_name, buffer.server_port, buffer.min_size,
+                                      n_steps,
+                                      data, make_sparse,
+                                      n_collect_envs=n_collect_envs,
+                                      collector_only=True) for _ in range(n_collectors)]
+
+    weights, version = ray.get(learner.get_weights.remote())
+    weights_ref = ray.put(weights)
+    # running collection tasks: future -> (collector, weights version it was dispatched with)
+    in_flight = {collector.collect.remote(collect_episodes, weights_ref, version): (collector, version)
+                 for collector in collectors}
+    for round_counter in range(1, n_rounds + 1):
+        weights, version = ray.get(learner.learn.remote(learner_steps))
+        weights_ref = ray.put(weights)
+
+        # bound staleness: wait for collectors, which still collect with too old weights
+        stale = [future for future, (_, task_version) in in_flight.items()
+                 if version - task_version > max_staleness]
+        ray.get(stale)
+        ready, _ = ray.wait(list(in_flight), num_returns=len(in_flight), timeout=0)
+        for future in set(ready) | set(stale):
+            collector, _ = in_flight.pop(future)
+            in_flight[collector.collect.remote(collect_episodes, weights_ref, version)] = (collector, version)
+
+        if round_counter % 10 == 0:
+            print(f"Round: {round_counter}, weights version: {version}, "
+                  f"oldest collecting version: {min(v for _, v in in_flight.values())}")
+
+    ray.get(list(in_flight))
+    reward = ray.get(learner.evaluate.remote(num_episodes=100))
+    print(f"Final reward with a model policy is {reward}")
+    data = {
+        'weights': weights,
+        'mask': list(map(lambda x: np.where(np.abs(x) < 0.1, 0., 1.), weights)),
+        'reward': reward,
+        'hidden_units': data.get('hidden_units') if data else None
     }
     with open('data/data.pickle', 'wb') as f:
         pickle.dump(data, f, pickle.HIGHEST_PROTOCOL)
 
+    # a shutdown stops actors of pools too
+    reset_actor_pools()
     ray.shutdown()
     print("Done")
 
 
+def prune_call(data_path='data/data.pickle'):
+    """
+    Removes dead neurons from a model of get_mlp() in data stored by one_call() or multi_call(),
+    next calls train a smaller dense model; data of other models (actor-critic, dueling) raise ValueError,
+    since their agents do not build models from hidden_units
+    """
+    with open(data_path, 'rb') as f:
+        data = pickle.load(f)
+    pruned = models.prune_mlp(data)
+    print(f"Hidden units: {[w.shape[1] for w in data['weights'][:-2:5]]} -> {pruned['hidden_units']}")
+    with open(data_path, 'wb') as f:
+        pickle.dump(pruned, f, pickle.HIGHEST_PROTOCOL)
+    return pruned
+
+
+class SweepTrial:
+    """
+    A trial of a sweep with its own buffer; an agent and a buffer are saved to trial_dir after every train call,
+    so a trial can be stopped and continued later by a new actor
+    """
+
+    def __init__(self, env_name, config, trial_dir):
+        config = dict(config)
+        agent_name = config.pop("agent_name", "double")
+        batch_size = config.pop("batch_size", 64)
+        n_steps = config.pop("n_steps", 2)
+        self._buffer = BUFFERS[agent_name](min_size=batch_size,
+                                           checkpoint_path=os.path.join(trial_dir, "buffer"))
+        self._agent = AGENTS[agent_name](env_name,
+                                         self._buffer.table_name, self._buffer.server_port, self._buffer.min_size,
+                                         n_steps,
+                                         None, False,
+                                         checkpoint_dir=os.path.join(trial_dir, "agent"),
+                                         **config)
+
+    def train(self, iterations_number):
+        """
+        iterations_number is a total budget of a rung, steps of previous rungs are counted in it
+        """
+        _, _, reward = self._agent.train(iterations_number=iterations_number)
+        self._buffer.checkpoint()
+        return reward
+
+
+def sweep_call(env_name, search_space, n_trials=27, n_workers=4,
+               min_budget=500, max_budget=4500, reduction_factor=3,
+               sweep_dir='data/sweep', seed=0):
+    """
+    Samples n_trials configs from search_space (see sweep.sample_config), e.g.
+    {"agent_name": ["double", "double_dueling", "categorical"], "epsilon": (0.01, 0.3),
+     "learning_rate": (1e-4, 1e-2), "n_steps": [2, 3, 4], "batch_size": [32, 64, 128]},
+    and trains them on n_workers Ray actors with asynchronous successive halving:
+    every trial gets min_budget training steps, the best trials continue up to max_budget.
+    Results are printed and appended to sweep_dir/results.jsonl as trials finish their rungs.
+    """
+    ray.init(ignore_reinit_error=True)
+    trial_object = ray.remote(SweepTrial)
+    scheduler = sweep.ASHAScheduler(min_budget, max_budget, reduction_factor)
+    rng = random.Random(seed)
+    configs = {}
+    # running train calls: future -> (trial id, rung, actor)
+    running = {}
+
+    def start(trial_id, rung):
+        actor = trial_object.remote(env_name, configs[trial_id], os.path.join(sweep_dir, f"trial_{trial_id}"))
+        running[actor.train.remote(scheduler.budgets[rung])] = (trial_id, rung, actor)
+
+    os.makedirs(sweep_dir, exist_ok=True)
+    with open(os.path.join(sweep_dir, 'results.jsonl'), 'a') as results_file:
+        while True:
+            # fill free workers with promoted trials first, then with new ones
+            while len(running) < n_workers:
+                promotion = scheduler.promotion()
+                if promotion:
+                    start(*promotion)
+                elif len(configs) < n_trials:
+                    trial_id = len(configs)
+                    configs[trial_id] = sweep.sample_config(search_space, rng)
+                    start(trial_id, 0)
+                else:
+                    break
+            if not running:
+                break
+
+            [future], _ = ray.wait(list(running))
+            trial_id, rung, actor = running.pop(future)
+            reward = float(ray.get(future))
+            # a stopped trial is continued from its checkpoints, if it is promoted
+            ray.kill(actor)
+            scheduler.report(trial_id, rung, reward)
+
+            result = {"trial": trial_id, "rung": rung, "steps": scheduler.budgets[rung],
+                      "reward": reward, "config": configs[trial_id]}
+            results_file.write(json.dumps(result) + "\n")
+            results_file.flush()
+            print(f"Trial #{trial_id}, steps: {result['steps']}, reward: {reward}, config: {configs[trial_id]}")
+
+    best_trial, best_reward = scheduler.best()
+    print(f"Best trial #{best_trial}: reward = {best_reward}, config: {configs[best_trial]}")
+    # a shutdown stops actors of pools too
+    reset_actor_pools()
+    ray.shutdown()
+    return configs[best_trial], best_reward
+
+
 if __name__ == '__main__':
     cart_pole = 'CartPole-v1'
     goose = 'gym_goose:goose-v0'
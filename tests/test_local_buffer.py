@@ -0,0 +1,49 @@
+import numpy as np
+import pytest
+
+pytest.importorskip("reverb")
+
+from tf_reinforcement_testcases import local_buffer, storage
+
+N_STEPS = 3
+BATCH_SIZE = 4
+OBSERVATION_SHAPE = (4,)  # CartPole
+
+
+def write_episode(buffer, precompute_returns, length=20):
+    episode = storage.EpisodeBuffer()
+    episode.reset(np.zeros(OBSERVATION_SHAPE, dtype=np.float32))
+    for step in range(1, length):
+        episode.append(step % 2, np.full(OBSERVATION_SHAPE, step, dtype=np.float32), 1., float(step == length - 1))
+    client = storage.make_client(buffer.server_port)
+    with client.writer(max_sequence_length=N_STEPS) as writer:
+        if precompute_returns:
+            return episode.write_n_step(writer, buffer.table_name, N_STEPS, discount_rate=0.99)
+        return episode.write(writer, buffer.table_name, N_STEPS)
+
+
+@pytest.mark.parametrize("precompute_returns", [False, True])
+@pytest.mark.parametrize("buffer_class", [local_buffer.UniformBuffer, local_buffer.PriorityBuffer])
+def test_initialize_dataset_samples_a_batch(buffer_class, precompute_returns):
+    buffer = buffer_class(min_size=BATCH_SIZE)
+    try:
+        assert write_episode(buffer, precompute_returns) >= BATCH_SIZE
+        dataset = storage.initialize_dataset(buffer.server_port, buffer.table_name, OBSERVATION_SHAPE,
+                                             BATCH_SIZE, N_STEPS, precompute_returns=precompute_returns)
+        sample = next(iter(dataset))
+    finally:
+        buffer.close()
+
+    actions, observations, rewards, dones = sample.data
+    if precompute_returns:
+        first_observations, last_observations = observations
+        assert first_observations.shape == last_observations.shape == (BATCH_SIZE,) + OBSERVATION_SHAPE
+        assert actions.shape == rewards.shape == dones.shape == (BATCH_SIZE,)
+        assert sample.info.key.shape == (BATCH_SIZE,)
+        # last observations are n_steps - 1 time steps after first ones
+        np.testing.assert_array_equal(last_observations - first_observations, N_STEPS - 1)
+    else:
+        assert observations.shape == (BATCH_SIZE, N_STEPS) + OBSERVATION_SHAPE
+        assert actions.shape == rewards.shape == dones.shape == (BATCH_SIZE, N_STEPS)
+        assert sample.info.key.shape == (BATCH_SIZE, N_STEPS)
+        np.testing.assert_array_equal(np.diff(observations.numpy()[:, :, 0], axis=1), 1.)
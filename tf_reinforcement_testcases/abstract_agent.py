@@ -1,13 +1,12 @@
 import abc
-import itertools as it
+from concurrent import futures
 
 import numpy as np
 import tensorflow as tf
 from tensorflow import keras
 import gym
-import reverb
 
-from tf_reinforcement_testcases import storage
+from tf_reinforcement_testcases import storage, models, profiling, numpy_inference
 
 
 class Agent(abc.ABC):
@@ -15,56 +14,171 @@ class Agent(abc.ABC):
     def __init__(self, env_name,
                  buffer_table_name, buffer_server_port, buffer_min_size,
                  n_steps=2,
-                 data=None, make_sparse=False):
+                 data=None, make_sparse=False,
+                 n_collect_envs=1, server_info_interval=100,
+                 precompute_returns=False,
+                 n_eval_envs=10, eval_ci_halfwidth=None,
+                 async_eval=False,
+                 float_storage_dtype=tf.float32,
+                 dataset_parameters=None,
+                 steps_per_call=1,
+                 target_update_tau=None,
+                 checkpoint_dir=None, checkpoint_interval=1000,
+                 jit_compile=False, mixed_precision=False,
+                 log_dir=None,
+                 epsilon=0.1, learning_rate=1e-3,
+                 collector_only=False,
+                 seed=None):
+        # a collector only agent (see collect()) has no evaluation environments, optimizer and dataset,
+        # and does not collect warm-up episodes
+        self._collector_only = collector_only
         # environments; their hyperparameters
         self._train_env = gym.make(env_name)
-        self._eval_env = gym.make(env_name)
+        # evaluation runs episodes on several environments at once
+        self._eval_envs = [] if collector_only else [gym.make(env_name) for _ in range(n_eval_envs)]
+        self._eval_env = self._eval_envs[0] if self._eval_envs else None
+        # if set, long evaluations stop when a 95% confidence interval of a mean reward is within +-eval_ci_halfwidth
+        self._eval_ci_halfwidth = eval_ci_halfwidth
+        # if async_eval, periodic evaluations run in a background thread on a copy of weights
+        self._async_eval = async_eval
+        self._eval_executor = futures.ThreadPoolExecutor(max_workers=1) if async_eval else None
+        self._eval_future = None
+        self._eval_model = None
+        self._eval_policy = None
+        # (training step, mean episode reward, seconds since the agent was made) of evaluations
+        self._eval_history = []
+        # copies of a training environment to collect experience from several episodes at once
+        self._n_collect_envs = n_collect_envs
+        self._collect_envs = [self._train_env] + [gym.make(env_name) for _ in range(n_collect_envs - 1)]
         self._n_outputs = self._train_env.action_space.n  # number of actions
         self._input_shape = self._train_env.observation_space.shape
+        # observations are stored in a buffer with the smallest exact dtypes, e.g. uint8 for maps
+        self._obs_dtypes = storage.observation_dtypes(self._train_env.observation_space, float_storage_dtype)
+        # numpy buffers to store episodes of collecting environments before sending them to a server
+        self._episode_buffers = [storage.EpisodeBuffer(obs_dtypes=self._obs_dtypes) for _ in self._collect_envs]
+        # if set, environments are seeded to make runs reproducible, see _seed_envs()
+        if seed is not None:
+            self._seed_envs(seed)
 
         # data contains weighs, masks, and a corresponding reward
         self._data = data
         self._is_sparse = make_sparse
+        # sizes of hidden layers of a pruned mlp, see models.prune_mlp(); None makes default ones
+        self._hidden_units = data.get('hidden_units') if data else None
         assert not (not data and make_sparse), "Making a sparse model needs data of weights and mask"
 
         # networks
         self._model = None
         self._target_model = None
+        # a dtype policy of models made by subclasses, it is passed to models makers to keep a global policy
+        # of a process as it is; bfloat16 needs no loss scaling, model outputs and losses stay float32
+        self._dtype_policy = 'mixed_bfloat16' if mixed_precision else None
+        # compile a training step of a subclass with XLA
+        if jit_compile:
+            training_step = type(self)._training_step
+            training_step = getattr(training_step, 'python_function', training_step)
+            self._training_step = tf.function(training_step.__get__(self), jit_compile=True)
 
         # fraction of random exp sampling
-        self._epsilon = 0.1
+        self._epsilon = epsilon
 
         # hyperparameters for optimization
-        self._optimizer = keras.optimizers.Adam(lr=1e-3)
+        self._optimizer = None if collector_only else keras.optimizers.Adam(lr=learning_rate)
         self._loss_fn = keras.losses.mean_squared_error
 
         # buffer; hyperparameters for a reward calculation
         self._table_name = buffer_table_name
         # an object with a client, which is used to store data on a server
-        self._replay_memory_client = reverb.Client(f'localhost:{buffer_server_port}')
+        self._replay_memory_client = storage.make_client(buffer_server_port)
         # make a batch size equal of a minimal size of a buffer
         self._sample_batch_size = buffer_min_size
         self._n_steps = n_steps  # 1. amount of steps stored per item, it should be at least 2;
         # 2. for details see function _collect_trajectories_from_episode()
-        # initialize a dataset to be used to sample data from a server
-        self._dataset = storage.initialize_dataset(buffer_server_port, buffer_table_name,
-                                                   self._input_shape, self._sample_batch_size, self._n_steps)
-        self._iterator = iter(self._dataset)
+        # if precompute_returns, items hold n-step returns calculated by collectors instead of n_steps time steps
+        self._precompute_returns = precompute_returns
+        # initialize a dataset to be used to sample data from a server;
+        # dataset_parameters tune sampling, see storage.initialize_dataset()
+        # a collector does not sample, a prefetching iterator would take items from a table in the background
+        self._dataset = None
+        self._iterator = None
+        if not collector_only:
+            self._dataset = storage.initialize_dataset(buffer_server_port, buffer_table_name,
+                                                       self._input_shape, self._sample_batch_size, self._n_steps,
+                                                       precompute_returns, self._obs_dtypes,
+                                                       **(dataset_parameters or {}))
+            self._iterator = iter(self._dataset)
         self._discount_rate = tf.constant(0.95, dtype=tf.float32)
         self._items_sampled = 0
+        # time and counts of training phases; if log_dir is set, they are written there for TensorBoard
+        self._timer = profiling.PhaseTimer(log_dir)
+        # items are counted locally, a server is asked for table stats only every server_info_interval steps
+        self._items_created = 0
+        # a number of episodes collected by _warm_up(), reset() repeats it
+        self._warm_up_episodes = None
+        self._server_info_interval = server_info_interval
+        self._target_model_update_interval = 100
+        # if set, a target model is softly updated after every training step instead of periodic copies
+        self._target_update_tau = None if target_update_tau is None else tf.constant(target_update_tau,
+                                                                                      dtype=tf.float32)
+        # a number of training steps made in one compiled call in train(), see _train_steps()
+        self._steps_per_call = steps_per_call
+        # a number of weights updates published by a learner, see learn() and collect()
+        self._weights_version = 0
+        self._learner_steps = 0
+
+        # training is resumed from the latest checkpoint in checkpoint_dir if there is one,
+        # checkpoints are written every checkpoint_interval steps, see _save_checkpoint()
+        self._checkpoint_dir = checkpoint_dir
+        self._checkpoint_interval = checkpoint_interval
+        self._checkpoint_manager = None
+        self._checkpoint_options = None
+        self._checkpoint_step = tf.Variable(0, dtype=tf.int64)
+        self._checkpoint_items = tf.Variable([0, 0], dtype=tf.int64)  # created and sampled items counts
+        # a number of made training steps, train() continues from it
+        self._step_counter = 0
+
+    def _action_values(self, predictions):
+        """
+        Converts model outputs to values, which are maximized by a greedy policy
+        """
+        return predictions
+
+    def _select_actions(self, predictions, epsilon):
+        """
+        Epsilon greedy actions for a batch of model outputs, it runs in graph
+        """
+        greedy_actions = tf.argmax(self._action_values(predictions), axis=-1, output_type=tf.int32)
+        batch_size = tf.shape(greedy_actions)[0]
+        random_actions = tf.random.uniform([batch_size], maxval=self._n_outputs, dtype=tf.int32)
+        return tf.where(tf.random.uniform([batch_size]) < epsilon, random_actions, greedy_actions)
 
     @tf.function
-    def _predict(self, observation):
-        return self._model(observation)
+    def _policy(self, observations, epsilon):
+        return self._select_actions(self._model(observations), epsilon)
+
+    def _make_policy(self, model):
+        """
+        Returns a compiled policy like _policy() for another model, e.g. a copy for evaluations
+        """
+        return tf.function(lambda observations, epsilon: self._select_actions(model(observations), epsilon))
 
     def _epsilon_greedy_policy(self, obs, epsilon):
-        if np.random.rand() < epsilon:
+        if epsilon >= 1:
             return np.random.randint(self._n_outputs)
-        else:
-            obs = tf.nest.map_structure(lambda x: tf.expand_dims(x, axis=0), obs)
-            # Q_values = self._model(obs)
-            Q_values = self._predict(obs)
-            return np.argmax(Q_values[0])
+        obs = tf.nest.map_structure(lambda x: np.asarray(x, dtype=np.float32)[None, ...], obs)
+        # epsilon is passed as a numpy value, so new values do not retrace the policy
+        return self._policy(obs, np.float32(epsilon)).numpy()[0]
+
+    def _epsilon_greedy_policy_batch(self, obs, epsilon, policy=None):
+        """
+        The same as _epsilon_greedy_policy, but for a batch of observations;
+        actions for the whole batch are chosen with one call of policy (self._policy by default)
+        """
+        if epsilon >= 1:
+            batch_size = tf.nest.flatten(obs)[0].shape[0]
+            return np.random.randint(self._n_outputs, size=batch_size)
+        policy = policy or self._policy
+        return policy(obs, np.float32(epsilon)).numpy()
 
     def _evaluate_episode(self, epsilon=0):
         """
@@ -81,11 +195,110 @@ class Agent(abc.ABC):
                 break
         return rewards
 
-    def _evaluate_episodes_greedy(self, num_episodes=3):
-        episode_rewards = 0
-        for _ in range(num_episodes):
-            episode_rewards += self._evaluate_episode()
-        return episode_rewards / num_episodes
+    def _evaluate_episodes_greedy(self, num_episodes=3, ci_halfwidth=None, min_episodes=10, policy=None):
+        """
+        Runs up to num_episodes greedy episodes on self._eval_envs simultaneously
+        with batched action selection, returns a mean episode reward.
+        If ci_halfwidth is set, new episodes are not started as soon as (after min_episodes)
+        a 95% confidence interval of the mean reward is within +-ci_halfwidth;
+        running episodes are finished to not bias the mean towards short episodes.
+        policy is passed to _epsilon_greedy_policy_batch.
+        """
+        episode_rewards = []
+        observations = [env.reset() for env in self._eval_envs]
+        rewards = np.zeros(len(self._eval_envs))
+        active = [i < num_episodes for i in range(len(self._eval_envs))]
+        episodes_started = sum(active)
+        while any(active):
+            obs_batch = tf.nest.map_structure(lambda *x: np.stack(x).astype(np.float32), *observations)
+            actions = self._epsilon_greedy_policy_batch(obs_batch, 0, policy)
+            for i, env in enumerate(self._eval_envs):
+                if not active[i]:
+                    continue
+                obs, reward, done, info = env.step(actions[i])
+                observations[i] = obs
+                rewards[i] += reward
+                if not done:
+                    continue
+                episode_rewards.append(rewards[i])
+                rewards[i] = 0
+                if episodes_started < num_episodes and not self._is_mean_precise(episode_rewards,
+                                                                                  ci_halfwidth, min_episodes):
+                    observations[i] = env.reset()
+                    episodes_started += 1
+                else:
+                    active[i] = False
+        return np.mean(episode_rewards)
+
+    def _seed_envs(self, seed):
+        """
+        Seeds collecting and evaluation environments with seed, seed + 1, ..., so their episodes differ
+        """
+        for i, env in enumerate(self._collect_envs + self._eval_envs):
+            if hasattr(env, "seed"):
+                env.seed(seed + i)
+            else:
+                # gym >= 0.26 seeds environments by reset()
+                env.reset(seed=seed + i)
+            env.action_space.seed(seed + i)
+
+    def _build_eval_model(self):
+        if self._is_sparse:
+            return models.get_sparse(self._data['weights'], self._data['mask'], dtype=self._dtype_policy)
+        return keras.models.clone_model(self._model)
+
+    def _report_evaluation(self, step, mean_episode_reward):
+        self._eval_history.append((step, mean_episode_reward, self._timer.elapsed()))
+        print("\rTraining step: {}, reward: {}, eps: {:.3f}".format(step,
+                                                                    mean_episode_reward,
+                                                                    self._epsilon))
+
+    def _evaluate_snapshot(self, step, weights):
+        self._eval_model.set_weights(weights)
+        mean_episode_reward = self._evaluate_episodes_greedy(policy=self._eval_policy)
+        self._report_evaluation(step, mean_episode_reward)
+        return mean_episode_reward
+
+    def _evaluate_in_background(self, step):
+        """
+        Evaluates a copy of current weights in a background thread, a result is reported with the step;
+        if a previous evaluation is still running, this one is skipped, so training never waits
+        """
+        if self._eval_future is not None and not self._eval_future.done():
+            return
+        if self._eval_model is None:
+            self._eval_model = self._build_eval_model()
+            self._eval_policy = self._make_policy(self._eval_model)
+        weights = self._model.get_weights()
+        self._eval_future = self._eval_executor.submit(self._evaluate_snapshot, step, weights)
+
+    def _wait_for_evaluation(self):
+        # raises an exception of a background evaluation if there was one
+        if self._eval_future is not None:
+            self._eval_future.result()
+
+    @staticmethod
+    def _is_mean_precise(episode_rewards, ci_halfwidth, min_episodes):
+        if ci_halfwidth is None or len(episode_rewards) < max(min_episodes, 2):
+            return False
+        halfwidth = 1.96 * np.std(episode_rewards, ddof=1) / np.sqrt(len(episode_rewards))
+        return halfwidth <= ci_halfwidth
+
+    def _write_episode(self, episode_buffer):
+        # an initial time step is not an environment step
+        self._timer.count("env_steps", len(episode_buffer) - 1)
+        self._timer.count("episodes")
+        with self._timer.phase("replay_write"):
+            self._write_episode_items(episode_buffer)
+
+    def _write_episode_items(self, episode_buffer):
+        if self._precompute_returns:
+            with self._replay_memory_client.writer(max_sequence_length=1) as writer:
+                self._items_created += episode_buffer.write_n_step(writer, self._table_name, self._n_steps,
+                                                                   self._discount_rate.numpy())
+        else:
+            with self._replay_memory_client.writer(max_sequence_length=self._n_steps) as writer:
+                self._items_created += episode_buffer.write(writer, self._table_name, self._n_steps)
 
     def _collect_trajectories_from_episode(self, epsilon):
         """
@@ -95,38 +308,103 @@ class Agent(abc.ABC):
         One 'time step' contains (action, obs, reward, done);
         action, reward, done are for the current observation (or obs);
         e.g. action led to the obs, reward prior the obs, if is it done at the current obs.
+        Time steps are stored in a numpy episode buffer and written to a server when an episode ends.
+        """
+        episode_buffer = self._episode_buffers[0]
+        obs = self._train_env.reset()
+        episode_buffer.reset(obs)
+        while True:
+            action = self._epsilon_greedy_policy(obs, epsilon)
+            obs, reward, done, info = self._train_env.step(action)
+            episode_buffer.append(action, obs, reward, done)
+            if done:
+                break
+        self._write_episode(episode_buffer)
+
+    def _collect_trajectories_from_envs(self, epsilon):
+        """
+        Collects one episode from every environment of self._collect_envs simultaneously.
+        Actions for all environments are chosen with one batched forward pass per step,
+        each environment fills its own episode buffer; items are the same
+        as in _collect_trajectories_from_episode().
         """
-        start_itemizing = self._n_steps - 2
-        with self._replay_memory_client.writer(max_sequence_length=self._n_steps) as writer:
-            obs = self._train_env.reset()
-            action, reward, done = tf.constant(-1), tf.constant(0.), tf.constant(0.)
-            obs = tf.nest.map_structure(lambda x: tf.convert_to_tensor(x, dtype=tf.float32), obs)
-            writer.append((action, obs, reward, done))
-            for step in it.count(0):
-                action = self._epsilon_greedy_policy(obs, epsilon)
-                obs, reward, done, info = self._train_env.step(action)
-                action = tf.convert_to_tensor(action, dtype=tf.int32)
-                reward = tf.convert_to_tensor(reward, dtype=tf.float32)
-                done = tf.convert_to_tensor(done, dtype=tf.float32)
-                obs = tf.nest.map_structure(lambda x: tf.convert_to_tensor(x, dtype=tf.float32), obs)
-                writer.append((action, obs, reward, done))
-                if step >= start_itemizing:
-                    writer.create_item(table=self._table_name, num_timesteps=self._n_steps, priority=1.)
+        observations = [env.reset() for env in self._collect_envs]
+        for episode_buffer, obs in zip(self._episode_buffers, observations):
+            episode_buffer.reset(obs)
+        active = [True] * len(self._collect_envs)
+        while any(active):
+            # finished environments keep their last observations in a batch,
+            # so the batch shape does not change and _policy is not retraced
+            obs_batch = tf.nest.map_structure(lambda *x: np.stack(x).astype(np.float32), *observations)
+            actions = self._epsilon_greedy_policy_batch(obs_batch, epsilon)
+            for i, env in enumerate(self._collect_envs):
+                if not active[i]:
+                    continue
+                obs, reward, done, info = env.step(actions[i])
+                observations[i] = obs
+                self._episode_buffers[i].append(actions[i], obs, reward, done)
                 if done:
-                    break
+                    active[i] = False
+                    self._write_episode(self._episode_buffers[i])
+
+    def _collect_episodes(self, epsilon):
+        """
+        Collects one episode from each collecting environment, returns a number of collected episodes
+        """
+        with self._timer.phase("collection"):
+            if self._n_collect_envs > 1:
+                self._collect_trajectories_from_envs(epsilon)
+            else:
+                self._collect_trajectories_from_episode(epsilon)
+        return self._n_collect_envs
 
     def _collect_several_episodes(self, epsilon, n_episodes):
-        for i in range(n_episodes):
-            self._collect_trajectories_from_episode(epsilon)
+        episodes_collected = 0
+        while episodes_collected < n_episodes:
+            episodes_collected += self._collect_episodes(epsilon)
+
+    def _sync_items_created(self):
+        """
+        Updates the local count of created items with the count from a server,
+        which also includes items inserted by other agents sharing the table
+        """
+        with self._timer.phase("replay_rpc"):
+            items_created = self._replay_memory_client.server_info()[self._table_name][5].insert_stats.completed
+        # a server may not have received the latest items yet
+        self._items_created = max(self._items_created, items_created)
+
+    def _table_size(self):
+        with self._timer.phase("replay_rpc"):
+            return self._replay_memory_client.server_info()[self._table_name].current_size
+
+    def _warm_up(self, epsilon, n_episodes):
+        # collectors fill a buffer with collect() calls
+        if self._collector_only:
+            return
+        # reset() collects warm-up episodes again into a cleared buffer
+        self._warm_up_episodes = n_episodes
+        # a buffer may already have enough items, e.g. a server outlived a resumed agent
+        if self._table_size() < self._sample_batch_size:
+            self._collect_several_episodes(epsilon, n_episodes)
 
     def _collect_until_items_created(self, epsilon, n_items):
+        if self._collector_only:
+            return
+        # a table restored from a snapshot has items, which are not counted as inserted
+        if self._table_size() >= n_items:
+            return
         # collect more exp if we do not have enough for a batch
-        items_created = self._replay_memory_client.server_info()[self._table_name][5].insert_stats.completed
-        while items_created < n_items:
-            self._collect_trajectories_from_episode(epsilon)
-            items_created = self._replay_memory_client.server_info()[self._table_name][5].insert_stats.completed
+        self._sync_items_created()
+        while self._items_created < n_items:
+            self._collect_episodes(epsilon)
 
     def _prepare_td_arguments(self, actions, observations, rewards, dones):
+        # the bootstrap discount is the same for all items, since an item ends either at done or at n_steps
+        if self._precompute_returns:
+            first_observations, last_observations = observations
+            last_discounted_gamma = self._discount_rate ** (self._n_steps - 1)
+            return rewards, first_observations, last_observations, dones, last_discounted_gamma, actions
+
         exponents = tf.expand_dims(tf.range(self._n_steps - 1, dtype=tf.float32), axis=1)
         gammas = tf.fill([self._n_steps - 1, 1], self._discount_rate.numpy())
         discounted_gammas = tf.pow(gammas, exponents)
@@ -143,56 +421,295 @@ class Agent(abc.ABC):
     def _training_step(self, actions, observations, rewards, dones, info):
         raise NotImplementedError
 
-    def train(self, iterations_number=10000):
+    def _process_training_step_outputs(self, outputs):
+        """
+        Gets outputs of _training_step() made by _train_on_sample(), e.g. new priorities of sampled items
+        """
+        pass
 
-        eval_interval = 100
-        target_model_update_interval = 100
+    def _flush_training_step_outputs(self):
+        """
+        Waits until outputs of _process_training_step_outputs() handled in background are done,
+        e.g. before a checkpoint is made or a process is stopped
+        """
+        pass
 
-        weights = None
-        mask = None
-        mean_episode_reward = 0
+    def _train_on_sample(self):
+        # dm-reverb returns tensors
+        with self._timer.phase("sampling"):
+            sample = next(self._iterator)
+        action, obs, reward, done = sample.data
+        key, probability, table_size, priority = sample.info
+        experiences, info = (action, obs, reward, done), (key, probability, table_size, priority)
+        self._items_sampled += self._sample_batch_size
 
-        for step_counter in range(1, iterations_number+1):
-            # collecting
-            items_created = self._replay_memory_client.server_info()[self._table_name][5].insert_stats.completed
-            # do not collect new experience if we have not used previous
-            if items_created < self._items_sampled:
-                self._collect_trajectories_from_episode(self._epsilon)
+        with self._timer.phase("training_step"):
+            outputs = self._training_step(*experiences, info=info)
+            if self._is_soft_target_update():
+                self._assign_target_model(self._target_update_tau)
+        self._process_training_step_outputs(outputs)
 
-            # dm-reverb returns tensors
+    @tf.function
+    def _train_steps(self, iterations_number):
+        """
+        Makes iterations_number training steps in one call, samples are taken from the dataset in graph
+        """
+        for _ in tf.range(iterations_number):
             sample = next(self._iterator)
             action, obs, reward, done = sample.data
             key, probability, table_size, priority = sample.info
             experiences, info = (action, obs, reward, done), (key, probability, table_size, priority)
-            self._items_sampled += self._sample_batch_size
-
             self._training_step(*experiences, info=info)
+            if self._is_soft_target_update():
+                self._assign_target_model(self._target_update_tau)
+
+    def _train_on_samples(self, iterations_number):
+        if iterations_number == 1:
+            self._train_on_sample()
+        else:
+            # the fused loop drops outputs of _training_step(), so they must not be needed
+            assert type(self)._process_training_step_outputs is Agent._process_training_step_outputs, \
+                "Training step outputs are processed only with steps_per_call=1"
+            # a tensor argument does not retrace the function for a different number of steps
+            with self._timer.phase("fused_sampling_and_training"):
+                self._train_steps(tf.constant(iterations_number))
+            self._items_sampled += iterations_number * self._sample_batch_size
+        self._timer.count("gradient_steps", iterations_number)
+        self._timer.count("items_sampled", iterations_number * self._sample_batch_size)
+
+    @staticmethod
+    def _is_interval_passed(interval, previous_step, step):
+        return step // interval > previous_step // interval
+
+    def _is_soft_target_update(self):
+        return self._target_model is not None and self._target_update_tau is not None
+
+    @tf.function
+    def _assign_target_model(self, tau):
+        """
+        target = tau * model + (1 - tau) * target for all variables, tau 1 copies a model to a target model
+        """
+        for target_variable, variable in zip(self._target_model.variables, self._model.variables):
+            target_variable.assign(tau * variable + (1. - tau) * target_variable)
+
+    def _update_target_model(self):
+        with self._timer.phase("target_sync"):
+            self._assign_target_model(tf.constant(1., dtype=tf.float32))
+
+    def _restore_checkpoint(self):
+        """
+        Makes a checkpoint of models, an optimizer state and counters;
+        restores them from the latest checkpoint in self._checkpoint_dir if there is one
+        """
+        objects = {"model": self._model, "optimizer": self._optimizer,
+                   "step": self._checkpoint_step, "items": self._checkpoint_items}
+        if self._target_model:
+            objects["target_model"] = self._target_model
+        checkpoint = tf.train.Checkpoint(**objects)
+        self._checkpoint_manager = tf.train.CheckpointManager(checkpoint, self._checkpoint_dir, max_to_keep=3)
+        try:
+            # write checkpoints in a background thread, training continues while files are written
+            self._checkpoint_options = tf.train.CheckpointOptions(experimental_enable_async_checkpoint=True)
+        except TypeError:
+            # older tensorflow versions write checkpoints synchronously
+            self._checkpoint_options = None
+
+        if self._checkpoint_manager.latest_checkpoint:
+            # optimizer slots are restored when they are created at the first training step
+            checkpoint.restore(self._checkpoint_manager.latest_checkpoint)
+            self._step_counter = int(self._checkpoint_step.numpy())
+            self._items_created, self._items_sampled = map(int, self._checkpoint_items.numpy())
+            print(f"Restored {self._checkpoint_manager.latest_checkpoint} at step {self._step_counter}")
+
+    def _save_checkpoint(self, wait=False):
+        """
+        If wait, returns after an async checkpoint is written, e.g. before a process can be stopped
+        """
+        checkpoint = self._checkpoint_manager.checkpoint
+        with self._timer.phase("checkpoint"):
+            # background updates of a buffer, e.g. priorities, belong to steps of the checkpoint
+            self._flush_training_step_outputs()
+            if wait and not hasattr(checkpoint, "sync"):
+                # older tensorflow versions cannot wait for an async checkpoint, write it synchronously
+                self._write_checkpoint(options=None)
+            else:
+                self._write_checkpoint(options=self._checkpoint_options)
+                if wait:
+                    checkpoint.sync()
+
+    def _write_checkpoint(self, options):
+        self._checkpoint_step.assign(self._step_counter)
+        self._checkpoint_items.assign([self._items_created, self._items_sampled])
+        self._checkpoint_manager.save(checkpoint_number=self._step_counter, options=options)
+
+    def get_weights(self):
+        return self._model.get_weights(), self._weights_version
+
+    def set_weights(self, weights, version):
+        self._model.set_weights(weights)
+        self._weights_version = version
+
+    def reset(self, weights=None):
+        """
+        Starts training over with weights or with newly initialized weights;
+        variables are assigned in place, so traced tf.functions are reused.
+        A buffer keeps its items, if it is cleared before (see main.get_actor_pool()),
+        warm-up episodes are collected again as by a new agent
+        """
+        self._wait_for_evaluation()
+        self._flush_training_step_outputs()
+        if weights is None:
+            models.reinitialize(self._model)
+        else:
+            self._model.set_weights(weights)
+        if self._target_model:
+            self._assign_target_model(tf.constant(1., dtype=tf.float32))
+        optimizer_variables = self._optimizer.variables
+        # optimizer variables are a method in older keras versions
+        for variable in (optimizer_variables() if callable(optimizer_variables) else optimizer_variables):
+            variable.assign(tf.zeros_like(variable))
+        self._step_counter = 0
+        self._weights_version = 0
+        self._learner_steps = 0
+        self._eval_history = []
+        if self._warm_up_episodes:
+            # random weights are warmed up with random actions, as in constructors of agents
+            self._warm_up(epsilon=1 if weights is None else self._epsilon, n_episodes=self._warm_up_episodes)
+
+    def collect(self, n_episodes, weights=None, version=None):
+        """
+        Collects episodes to a buffer without training, it is used by collector actors;
+        weights of the given version replace the current ones unless they are older,
+        so collectors pick up the initial weights (version 0) of a learner too.
+        Returns a version of weights used for collecting.
+        """
+        if weights is not None and version >= self._weights_version:
+            self.set_weights(weights, version)
+        self._collect_several_episodes(self._epsilon, n_episodes)
+        return self._weights_version
 
-            if step_counter % eval_interval == 0:
-                mean_episode_reward = self._evaluate_episodes_greedy()
-                print("\rTraining step: {}, reward: {}, eps: {:.3f}".format(step_counter,
-                                                                            mean_episode_reward,
-                                                                            self._epsilon))
-                print(f"Created items count: {items_created}")
+    def learn(self, iterations_number):
+        """
+        Makes training steps on samples from a buffer without collecting, it is used by a learner actor;
+        returns updated weights and their new version.
+        """
+        for _ in range(iterations_number):
+            self._train_on_sample()
+            self._learner_steps += 1
+            if self._target_model and not self._is_soft_target_update() and \
+                    self._learner_steps % self._target_model_update_interval == 0:
+                self._update_target_model()
+        self._weights_version += 1
+        return self.get_weights()
+
+    def _export_model(self):
+        """
+        Returns a numpy_inference.NumpyModel of the model
+        """
+        if self._is_sparse:
+            return numpy_inference.export_sparse(self._model)
+        return numpy_inference.export_mlp(self._model)
+
+    def _make_numpy_policy(self, numpy_model):
+        return numpy_inference.NumpyPolicy(numpy_model, self._n_outputs)
+
+    def export_policy(self, path=None, quantize=False):
+        """
+        Returns a numpy_inference.NumpyPolicy with current weights, which runs without tensorflow;
+        if quantize, kernels are stored in int8; if path is set, the policy is saved there (see load_policy())
+        """
+        numpy_model = self._export_model()
+        if quantize:
+            numpy_model = numpy_model.quantize()
+        policy = self._make_numpy_policy(numpy_model)
+        if path:
+            policy.save(path)
+        return policy
+
+    def get_statistics(self):
+        """
+        Returns phase times, counters and memory of the agent process (see profiling.PhaseTimer)
+        together with evaluations history
+        """
+        statistics = self._timer.summary()
+        statistics["evaluations"] = list(self._eval_history)
+        return statistics
+
+    def evaluate(self, num_episodes=100):
+        return self._evaluate_episodes_greedy(num_episodes=num_episodes, ci_halfwidth=self._eval_ci_halfwidth)
+
+    def train(self, iterations_number=10000):
+        """
+        Trains until iterations_number steps are made, including steps of previous calls or a restored checkpoint
+        (reset() starts counting over); if they are already made, the current model is only evaluated.
+        Returns weights, a mask and a final mean reward of the current model.
+        """
+
+        eval_interval = 100
+
+        if self._checkpoint_dir and self._checkpoint_manager is None:
+            self._restore_checkpoint()
+        self._sync_items_created()
+        step_counter = self._step_counter
+        while step_counter < iterations_number:
+            # steps_per_call training steps are made at once,
+            # so intervals are checked for being passed between previous_step and step_counter
+            previous_step = step_counter
+            step_counter = min(step_counter + self._steps_per_call, iterations_number)
+
+            # collecting
+            if self._is_interval_passed(self._server_info_interval, previous_step, step_counter):
+                self._sync_items_created()
+            # do not collect new experience if we have not used previous
+            if self._items_created < self._items_sampled:
+                self._collect_episodes(self._epsilon)
+
+            self._train_on_samples(step_counter - previous_step)
+            self._step_counter = step_counter
+
+            if self._is_interval_passed(eval_interval, previous_step, step_counter):
+                with self._timer.phase("evaluation"):
+                    if self._async_eval:
+                        self._evaluate_in_background(step_counter)
+                    else:
+                        mean_episode_reward = self._evaluate_episodes_greedy()
+                        self._report_evaluation(step_counter, mean_episode_reward)
+                print(f"Created items count: {self._items_created}")
                 print(f"Sampled items count: {self._items_sampled}")
+                if self._timer.time("sampling") > 0:
+                    print(f"Sampled items per second of waiting: "
+                          f"{self._items_sampled / self._timer.time('sampling'):.0f}")
+                self._timer.write(step_counter)
 
             # update target model weights
-            if self._target_model and step_counter % target_model_update_interval == 0:
-                weights = self._model.get_weights()
-                self._target_model.set_weights(weights)
-
-            # store weights at the last step
-            if step_counter % iterations_number == 0:
-                mean_episode_reward = self._evaluate_episodes_greedy(num_episodes=100)
-                print(f"Final reward with a model policy is {mean_episode_reward}")
-                # do not update data in case of sparse net
-                # currently the only way to make a sparse net is from a dense net weights and mask
-                if self._is_sparse:
-                    weights = self._data['weights']
-                    mask = self._data['mask']
-                    mean_episode_reward = self._data['reward']
-                else:
-                    weights = self._model.get_weights()
-                    mask = list(map(lambda x: np.where(np.abs(x) < 0.1, 0., 1.), weights))
+            if self._target_model and not self._is_soft_target_update() and \
+                    self._is_interval_passed(self._target_model_update_interval, previous_step, step_counter):
+                self._update_target_model()
+
+            if self._checkpoint_manager and (step_counter == iterations_number or self._is_interval_passed(
+                    self._checkpoint_interval, previous_step, step_counter)):
+                # a caller may stop the process after train() returns, e.g. a sweep kills its actors
+                self._save_checkpoint(wait=step_counter == iterations_number)
+
+        # a caller may stop the process after train() returns
+        self._flush_training_step_outputs()
+        # store weights at the last step, it is also a step of a restored checkpoint, which is already trained
+        # evaluation environments are shared with a background evaluation
+        with self._timer.phase("evaluation"):
+            self._wait_for_evaluation()
+            mean_episode_reward = self._evaluate_episodes_greedy(num_episodes=100,
+                                                                 ci_halfwidth=self._eval_ci_halfwidth)
+        print(f"Final reward with a model policy is {mean_episode_reward}")
+        self._eval_history.append((step_counter, mean_episode_reward, self._timer.elapsed()))
+        self._timer.write(step_counter)
+        # do not update data in case of sparse net
+        # currently the only way to make a sparse net is from a dense net weights and mask
+        if self._is_sparse:
+            weights = self._data['weights']
+            mask = self._data['mask']
+            mean_episode_reward = self._data['reward']
+        else:
+            weights = self._model.get_weights()
+            mask = list(map(lambda x: np.where(np.abs(x) < 0.1, 0., 1.), weights))
 
         return weights, mask, mean_episode_reward
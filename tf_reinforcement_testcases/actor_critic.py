@@ -1,8 +1,7 @@
-import numpy as np
 import tensorflow as tf
 
 from tf_reinforcement_testcases.abstract_agent import Agent
-from tf_reinforcement_testcases import models
+from tf_reinforcement_testcases import models, numpy_inference
 
 
 class ACAgent(Agent):
@@ -14,24 +13,23 @@ class ACAgent(Agent):
 
         # train a model from scratch
         if self._data is None:
-            self._model = models.get_actor_critic(self._input_shape, self._n_outputs)
+            self._model = models.get_actor_critic(self._input_shape, self._n_outputs, dtype=self._dtype_policy)
             # collect some data with a random policy (epsilon 1 corresponds to it) before training
-            self._collect_several_episodes(epsilon=1, n_episodes=10)
+            self._warm_up(epsilon=1, n_episodes=10)
         # continue a model training
         elif self._data and not self._is_sparse:
-            self._model = models.get_actor_critic(self._input_shape, self._n_outputs)
+            self._model = models.get_actor_critic(self._input_shape, self._n_outputs, dtype=self._dtype_policy)
             self._model.set_weights(self._data['weights'])
             # collect date with epsilon greedy policy
-            self._collect_several_episodes(epsilon=self._epsilon, n_episodes=10)
-
-    def _epsilon_greedy_policy(self, obs, epsilon):
-        if np.random.rand() < epsilon:
-            return np.random.randint(self._n_outputs)
-        else:
-            obs = tf.nest.map_structure(lambda x: tf.expand_dims(x, axis=0), obs)
-            logits, Q_values = self._predict(obs)
-            probabilities = tf.nn.softmax(logits)
-            return np.argmax(probabilities[0])  # switch to sample categorical
+            self._warm_up(epsilon=self._epsilon, n_episodes=10)
+
+    def _export_model(self):
+        return numpy_inference.export_actor_critic(self._model)
+
+    def _action_values(self, predictions):
+        logits, Q_values = predictions
+        probabilities = tf.nn.softmax(logits)
+        return probabilities  # switch to sample categorical
 
     def _training_step(self, actions, observations, rewards, dones, info):
 
@@ -1,7 +1,7 @@
 import numpy as np
 import tensorflow as tf
 
-from tf_reinforcement_testcases import models, misc
+from tf_reinforcement_testcases import models, misc, storage, numpy_inference
 from tf_reinforcement_testcases.abstract_agent import Agent
 
 
@@ -12,22 +12,24 @@ class RegularDQNAgent(Agent):
 
         # train a model from scratch
         if self._data is None:
-            self._model = models.get_mlp(self._input_shape, self._n_outputs)
+            self._model = models.get_mlp(self._input_shape, self._n_outputs, self._hidden_units,
+                                         dtype=self._dtype_policy)
             # collect some data with a random policy (epsilon 1 corresponds to it) before training
-            self._collect_several_episodes(epsilon=1, n_episodes=self._sample_batch_size)
+            self._warm_up(epsilon=1, n_episodes=self._sample_batch_size)
         # continue a model training
         elif self._data and not self._is_sparse:
-            self._model = models.get_mlp(self._input_shape, self._n_outputs)
+            self._model = models.get_mlp(self._input_shape, self._n_outputs, self._hidden_units,
+                                         dtype=self._dtype_policy)
             self._model.set_weights(self._data['weights'])
             # collect date with epsilon greedy policy
-            self._collect_several_episodes(epsilon=self._epsilon, n_episodes=self._sample_batch_size)
+            self._warm_up(epsilon=self._epsilon, n_episodes=self._sample_batch_size)
         # make and train a sparse model from a dense model
         elif self._data and self._is_sparse:
             weights = self._data['weights']
             random_weights = [np.random.uniform(low=-0.03, high=0.03, size=item.shape) for item in weights]
-            self._model = models.get_sparse(random_weights, self._data['mask'])
+            self._model = models.get_sparse(random_weights, self._data['mask'], dtype=self._dtype_policy)
             # collect some data with a random policy (epsilon 1 corresponds to it) before training
-            self._collect_several_episodes(epsilon=1, n_episodes=self._sample_batch_size)
+            self._warm_up(epsilon=1, n_episodes=self._sample_batch_size)
 
     @tf.function
     def _training_step(self, actions, observations, rewards, dones, info):
@@ -58,11 +60,12 @@ class FixedQValuesDQNAgent(RegularDQNAgent):
 
         if self._is_sparse:
             # make a target model with the weights stored in data
-            self._target_model = models.get_sparse(self._data['weights'], self._data['mask'])
+            self._target_model = models.get_sparse(self._data['weights'], self._data['mask'], dtype=self._dtype_policy)
             # replace weights of the target model with a weights from the model
             self._target_model.set_weights(self._model.get_weights())
         else:
-            self._target_model = models.get_mlp(self._input_shape, self._n_outputs)
+            self._target_model = models.get_mlp(self._input_shape, self._n_outputs, self._hidden_units,
+                                                dtype=self._dtype_policy)
             self._target_model.set_weights(self._model.get_weights())
 
     @tf.function
@@ -126,23 +129,30 @@ class DoubleDuelingDQNAgent(DoubleDQNAgent):
 
         # train a model from scratch
         if self._data is None:
-            self._model = models.get_dueling_q_mlp(self._input_shape, self._n_outputs)
+            self._model = models.get_dueling_q_mlp(self._input_shape, self._n_outputs, dtype=self._dtype_policy)
             # collect some data with a random policy (epsilon 1 corresponds to it) before training
-            self._collect_several_episodes(epsilon=1, n_episodes=self._sample_batch_size)
+            self._warm_up(epsilon=1, n_episodes=self._sample_batch_size)
         # continue a model training
         elif self._data and not self._is_sparse:
-            self._model = models.get_dueling_q_mlp(self._input_shape, self._n_outputs)
+            self._model = models.get_dueling_q_mlp(self._input_shape, self._n_outputs, dtype=self._dtype_policy)
             self._model.set_weights(self._data['weights'])
             # collect date with epsilon greedy policy
-            self._collect_several_episodes(epsilon=self._epsilon, n_episodes=self._sample_batch_size)
+            self._warm_up(epsilon=self._epsilon, n_episodes=self._sample_batch_size)
 
-        self._target_model = models.get_dueling_q_mlp(self._input_shape, self._n_outputs)
+        self._target_model = models.get_dueling_q_mlp(self._input_shape, self._n_outputs, dtype=self._dtype_policy)
         self._target_model.set_weights(self._model.get_weights())
 
+    def _export_model(self):
+        return numpy_inference.export_dueling_q_mlp(self._model)
+
 
 class CategoricalDQNAgent(Agent):
+    """
+    projection selects a function from misc.PROJECTIONS to align target distributions:
+    'linear' is O(batch * atoms), 'tiled' is the original O(batch * atoms^2) one
+    """
 
-    def __init__(self, env_name, *args, **kwargs):
+    def __init__(self, env_name, *args, projection="linear", **kwargs):
         super().__init__(env_name, *args, **kwargs)
 
         min_q_value = 0
@@ -150,40 +160,46 @@ class CategoricalDQNAgent(Agent):
         self._n_atoms = 51
         self._support = tf.linspace(min_q_value, max_q_value, self._n_atoms)
         self._support = tf.cast(self._support, tf.float32)
+        self._project_distribution = misc.PROJECTIONS[projection]
         cat_n_outputs = self._n_outputs * self._n_atoms
         # train a model from scratch
         if self._data is None:
-            self._model = models.get_mlp(self._input_shape, cat_n_outputs)
+            self._model = models.get_mlp(self._input_shape, cat_n_outputs, self._hidden_units, dtype=self._dtype_policy)
             # collect some data with a random policy (epsilon 1 corresponds to it) before training
             # self._collect_several_episodes(epsilon=1, n_episodes=self._sample_batch_size)
             self._collect_until_items_created(epsilon=1, n_items=self._sample_batch_size)
         # continue a model training
         elif self._data and not self._is_sparse:
-            self._model = models.get_mlp(self._input_shape, cat_n_outputs)
+            self._model = models.get_mlp(self._input_shape, cat_n_outputs, self._hidden_units, dtype=self._dtype_policy)
             self._model.set_weights(self._data['weights'])
             # collect date with epsilon greedy policy
-            self._collect_several_episodes(epsilon=self._epsilon, n_episodes=self._sample_batch_size)
+            self._warm_up(epsilon=self._epsilon, n_episodes=self._sample_batch_size)
         # make and train a sparse model from a dense model
         elif self._data and self._is_sparse:
             weights = self._data['weights']
             random_weights = [np.random.uniform(low=-0.03, high=0.03, size=item.shape) for item in weights]
-            self._model = models.get_sparse(random_weights, self._data['mask'])
+            self._model = models.get_sparse(random_weights, self._data['mask'], dtype=self._dtype_policy)
             # collect some data with a random policy (epsilon 1 corresponds to it) before training
-            self._collect_several_episodes(epsilon=1, n_episodes=self._sample_batch_size)
+            self._warm_up(epsilon=1, n_episodes=self._sample_batch_size)
 
-        reward = self._evaluate_episodes_greedy(num_episodes=100)
-        print(f"Initial reward with a model policy is {reward}")
+        if not self._collector_only:
+            reward = self._evaluate_episodes_greedy(num_episodes=100, ci_halfwidth=self._eval_ci_halfwidth)
+            print(f"Initial reward with a model policy is {reward}")
 
-    def _epsilon_greedy_policy(self, obs, epsilon):
-        if np.random.rand() < epsilon:
-            return np.random.randint(self._n_outputs)
-        else:
-            obs = tf.nest.map_structure(lambda x: tf.expand_dims(x, axis=0), obs)
-            logits = self._predict(obs)
-            logits = tf.reshape(logits, [-1, self._n_outputs, self._n_atoms])
-            probabilities = tf.nn.softmax(logits)
-            Q_values = tf.reduce_sum(self._support * probabilities, axis=-1)  # Q values expected return
-            return np.argmax(Q_values[0])
+    def _make_numpy_policy(self, numpy_model):
+        return numpy_inference.NumpyPolicy(numpy_model, self._n_outputs, support=self._support.numpy())
+
+    def _importance_weights(self, info):
+        """
+        Returns weights of losses of sampled items, uniform sampling needs no correction
+        """
+        return tf.constant(1.)
+
+    def _action_values(self, predictions):
+        logits = tf.reshape(predictions, [-1, self._n_outputs, self._n_atoms])
+        probabilities = tf.nn.softmax(logits)
+        Q_values = tf.reduce_sum(self._support * probabilities, axis=-1)  # Q values expected return
+        return Q_values
 
     @tf.function
     def _training_step(self, actions, observations, rewards, dones, info):
@@ -210,9 +226,9 @@ class CategoricalDQNAgent(Agent):
         non_aligned_support = total_rewards + (tf.constant(1.0) - last_dones) * last_discounted_gamma * batch_support
 
         # Part 3: project the target Q value distributions to the basic (target_support) support
-        target_distribution = misc.project_distribution(supports=non_aligned_support,
-                                                        weights=next_best_probs,
-                                                        target_support=self._support)
+        target_distribution = self._project_distribution(supports=non_aligned_support,
+                                                         weights=next_best_probs,
+                                                         target_support=self._support)
 
         # Part 4: Loss and update
         indices = tf.cast(batch_indices[:, 0], second_actions.dtype)
@@ -223,7 +239,7 @@ class CategoricalDQNAgent(Agent):
             chosen_action_logits = tf.gather_nd(logits, reshaped_actions)
             loss = tf.nn.softmax_cross_entropy_with_logits(labels=target_distribution,
                                                            logits=chosen_action_logits)
-            loss = tf.reduce_mean(loss)
+            loss = tf.reduce_mean(self._importance_weights(info) * loss)
         grads = tape.gradient(loss, self._model.trainable_variables)
         self._optimizer.apply_gradients(zip(grads, self._model.trainable_variables))
         return target_distribution, chosen_action_logits
@@ -231,37 +247,49 @@ class CategoricalDQNAgent(Agent):
 
 class PriorityCategoricalDQNAgent(CategoricalDQNAgent):
     """
-    It is unclear how reverb samples and how to change priorities if an item consist of
-    several time steps
-    Below implementation is for items of one time step
+    Uses a buffer with prioritized sampling (storage.PriorityBuffer).
+    Losses are weighted by importance sampling weights computed in graph from sampling probabilities;
+    reverb repeats sample info for every time step of an item, the first one is used.
+    new priorities of sampled items are queued to a storage.PriorityUpdater,
+    which sends them to a server in batches from a background thread.
+    A priority of an item of n_steps time steps is a priority of its first transition.
     """
 
     def __init__(self, env_name, *args, **kwargs):
         super().__init__(env_name, *args, **kwargs)
 
-        raise NotImplementedError
+        # priorities are updated after every step, so steps are not fused into one call
+        if self._steps_per_call != 1:
+            raise ValueError(f"A priority agent makes one step per call, got steps_per_call={self._steps_per_call}")
 
-        # for priory buffer version
-        self._importance_sampling = tf.constant(1.)  # should be multiplied by loss
-
-        # priority buffer hyperparameters
-        self._n_elements_in_buffer = None
+        # priority buffer hyperparameters, beta is annealed to 1 by beta_increment per step
         self._beta = tf.Variable(0.4, dtype=tf.float32)
         self._beta_increment = tf.constant(0.0001, dtype=tf.float32)
+        # collectors do not train, so they do not update priorities
+        self._priority_updater = None if self._collector_only else \
+            storage.PriorityUpdater(self._replay_memory_client, self._table_name)
 
-    def _training_step(self, actions, observations, rewards, dones, info):
-        # update importance sampling hyperparameter
-        keys = info[0]
+    @staticmethod
+    def _first_transition_info(info):
+        # info of items of n_steps time steps is [batch, n_steps], of precomputed returns items is [batch]
+        return tf.nest.map_structure(lambda x: x[:, 0] if x.shape.rank == 2 else x, info)
+
+    def _importance_weights(self, info):
         # dm-reverb info has a float64 format, which is incompatible
-        info = tf.nest.map_structure(lambda x: tf.cast(x, dtype=tf.float32), info[1:])
-        probs, table_sizes, priors = info
-        beta = tf.reduce_min(tf.stack([tf.constant(1.0), self._beta + self._beta_increment]))
-        importance_sampling = tf.pow(self._n_elements_in_buffer * probs, -beta)
-        max_importance = tf.reduce_max(importance_sampling)
-        self._importance_sampling = importance_sampling / max_importance
+        _, probabilities, table_sizes, _ = self._first_transition_info(info)
+        probabilities = tf.cast(probabilities, tf.float32)
+        table_sizes = tf.cast(table_sizes, tf.float32)
+        self._beta.assign(tf.minimum(tf.constant(1.), self._beta + self._beta_increment))
+        importance_sampling = tf.pow(table_sizes * probabilities, -self._beta)
+        return importance_sampling / tf.reduce_max(importance_sampling)
+
+    @tf.function
+    def _training_step(self, actions, observations, rewards, dones, info):
+        keys = self._first_transition_info(info)[0]
 
         # the main part
-        target_distribution, chosen_action_logits = super()._training_step(actions, observations, rewards, dones, info)
+        target_distribution, chosen_action_logits = super(PriorityCategoricalDQNAgent, self)._training_step(
+            actions, observations, rewards, dones, info)
         probabilities = tf.nn.softmax(chosen_action_logits)
         Q_values = tf.reduce_sum(self._support * probabilities, axis=-1)
         next_Q_values = tf.reduce_sum(self._support * target_distribution, axis=-1)
@@ -272,5 +300,13 @@ class PriorityCategoricalDQNAgent(CategoricalDQNAgent):
         clipped_errors = tf.minimum(absolute_errors, tf.constant([1.]))  # errors from 0.01 to 1.
         new_priorities = tf.pow(clipped_errors, tf.constant([0.6]))  # increase prob of the less prob priorities
         new_priorities = tf.cast(new_priorities, dtype=tf.float64)
-        new_priorities = tf.squeeze(new_priorities, axis=-1)
-        self._replay_memory_client.update_priorities(self._table_name, keys, new_priorities)
+        return keys, new_priorities
+
+    def _process_training_step_outputs(self, outputs):
+        keys, new_priorities = outputs
+        self._priority_updater.put(keys.numpy(), new_priorities.numpy())
+        self._timer.count("priority_updates", len(keys))
+
+    def _flush_training_step_outputs(self):
+        if self._priority_updater is not None:
+            self._priority_updater.flush()
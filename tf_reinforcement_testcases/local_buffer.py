@@ -0,0 +1,347 @@
+"""
+An in-process replay buffer with the interface of storage.UniformBuffer and storage.PriorityBuffer
+for single process runs: items are kept in preallocated numpy arrays and sampled by vectorized indexing,
+no gRPC calls and no serialization are made.
+A buffer registers its tables under a made up server_port (out of the range of tcp ports),
+storage.make_client() and storage.initialize_dataset() use the port to find the tables.
+"""
+import collections
+import itertools
+import os
+import pickle
+import threading
+
+import numpy as np
+import tensorflow as tf
+
+# server_port -> {table name: Table}
+SERVERS = {}
+_ports = itertools.count(2 ** 16)
+
+# the same fields as reverb has, the agents read them
+ReplaySample = collections.namedtuple('ReplaySample', ['info', 'data'])
+SampleInfo = collections.namedtuple('SampleInfo', ['key', 'probability', 'table_size', 'priority'])
+TableInfo = collections.namedtuple('TableInfo', ['name', 'sampler_options', 'remover_options', 'max_size',
+                                                 'max_times_sampled', 'rate_limiter_info', 'signature',
+                                                 'current_size'])
+RateLimiterInfo = collections.namedtuple('RateLimiterInfo', ['insert_stats', 'sample_stats'])
+CallStats = collections.namedtuple('CallStats', ['completed'])
+
+
+def is_local(server_port):
+    return server_port in SERVERS
+
+
+class SumTree:
+    """
+    A binary tree of sums of priorities over a power of two number of leaves;
+    updates and searches run for a batch of leaves at once, level by level
+    """
+
+    def __init__(self, capacity):
+        self._n_leaves = 1 << max(int(capacity) - 1, 1).bit_length()
+        self._depth = self._n_leaves.bit_length() - 1
+        self._nodes = np.zeros(2 * self._n_leaves, dtype=np.float64)
+
+    @property
+    def total(self):
+        return self._nodes[1]
+
+    def get(self, indices):
+        return self._nodes[indices + self._n_leaves]
+
+    def update(self, indices, values):
+        nodes = indices + self._n_leaves
+        self._nodes[nodes] = values
+        for _ in range(self._depth):
+            nodes = np.unique(nodes // 2)
+            self._nodes[nodes] = self._nodes[2 * nodes] + self._nodes[2 * nodes + 1]
+
+    def find(self, values):
+        """
+        Returns indices of leaves, where cumulative sums of priorities reach values
+        """
+        nodes = np.ones(len(values), dtype=np.int64)
+        for _ in range(self._depth):
+            left = 2 * nodes
+            # do not step to empty leaves because of rounding errors
+            is_right = (values >= self._nodes[left]) & (self._nodes[left + 1] > 0)
+            values = np.where(is_right, values - self._nodes[left], values)
+            nodes = left + is_right
+        return nodes - self._n_leaves
+
+
+class Table:
+    """
+    A ring buffer of items with fifo removal and min size rate limiting,
+    sampled uniformly or, if priority_exponent is set, proportionally to priority ** priority_exponent
+    """
+
+    def __init__(self, name, max_size, min_size, priority_exponent=None):
+        self._name = name
+        self._max_size = int(max_size)
+        self._min_size = min_size
+        self._priority_exponent = priority_exponent
+        self._tree = SumTree(self._max_size) if priority_exponent is not None else None
+        # arrays with the structure of items, they are allocated by the first insert
+        self._items = None
+        self._keys = np.zeros(self._max_size, dtype=np.uint64)
+        self._priorities = np.zeros(self._max_size, dtype=np.float64)
+        self._size = 0
+        # keys are numbers of inserts, items restored from a snapshot are not counted as inserted by the table
+        self._inserted = 0
+        self._restored = 0
+        self._condition = threading.Condition()
+
+    @property
+    def name(self):
+        return self._name
+
+    def info(self):
+        return TableInfo(name=self._name, sampler_options=None, remover_options=None, max_size=self._max_size,
+                         max_times_sampled=0,
+                         rate_limiter_info=RateLimiterInfo(insert_stats=CallStats(self._inserted - self._restored),
+                                                           sample_stats=None),
+                         signature=None, current_size=self._size)
+
+    def insert(self, items, priorities):
+        """
+        Inserts a batch of items, every array of items has a batch dimension first
+        """
+        priorities = np.asarray(priorities, dtype=np.float64)
+        n_items = len(priorities)
+        with self._condition:
+            if self._items is None:
+                self._items = tf.nest.map_structure(
+                    lambda x: np.zeros((self._max_size,) + x.shape[1:], dtype=x.dtype), items)
+            # only the last max_size items fit
+            start = max(n_items - self._max_size, 0)
+            keys = np.arange(self._inserted + start, self._inserted + n_items, dtype=np.uint64)
+            indices = (keys % self._max_size).astype(np.int64)
+            tf.nest.map_structure(lambda table, x: table.__setitem__(indices, x[start:]), self._items, items)
+            self._keys[indices] = keys
+            self._set_priorities(indices, priorities[start:])
+            self._inserted += n_items
+            self._size = min(self._size + n_items, self._max_size)
+            self._condition.notify_all()
+
+    def _set_priorities(self, indices, priorities):
+        self._priorities[indices] = priorities
+        if self._tree is not None:
+            self._tree.update(indices, priorities ** self._priority_exponent)
+
+    def sample(self, batch_size):
+        """
+        Waits until the table has min_size items, returns a batch of items and its SampleInfo
+        """
+        with self._condition:
+            self._condition.wait_for(lambda: self._size >= self._min_size)
+            if self._tree is None:
+                # items are the last size inserted ones, they start at any place of a ring after clear()
+                start = self._inserted - self._size
+                indices = (start + np.random.randint(self._size, size=batch_size)) % self._max_size
+                probabilities = np.full(batch_size, 1. / self._size)
+            else:
+                total = self._tree.total
+                indices = self._tree.find(np.random.uniform(0., total, size=batch_size))
+                probabilities = self._tree.get(indices) / total
+            items = tf.nest.map_structure(lambda x: x[indices], self._items)
+            info = SampleInfo(key=self._keys[indices], probability=probabilities,
+                              table_size=np.full(batch_size, self._size, dtype=np.int64),
+                              priority=self._priorities[indices])
+        return items, info
+
+    def mutate_priorities(self, updates):
+        """
+        updates are key -> priority, keys of removed items are skipped
+        """
+        keys = np.fromiter(updates.keys(), dtype=np.uint64, count=len(updates))
+        priorities = np.fromiter(updates.values(), dtype=np.float64, count=len(updates))
+        with self._condition:
+            indices = (keys % self._max_size).astype(np.int64)
+            is_present = self._keys[indices] == keys
+            self._set_priorities(indices[is_present], priorities[is_present])
+
+    def clear(self):
+        """
+        Removes all items, keys of next items continue numbers of inserts
+        """
+        with self._condition:
+            # no key matches a removed item, so its priority is not updated
+            self._keys[:] = np.iinfo(np.uint64).max
+            self._set_priorities(np.arange(self._max_size), np.zeros(self._max_size))
+            self._size = 0
+
+    def state(self):
+        with self._condition:
+            return {"items": self._items, "keys": self._keys, "priorities": self._priorities,
+                    "size": self._size, "inserted": self._inserted}
+
+    def restore(self, state):
+        with self._condition:
+            self._items = state["items"]
+            self._keys = state["keys"]
+            self._size = state["size"]
+            self._inserted = state["inserted"]
+            self._restored = state["inserted"]
+            self._set_priorities(np.arange(self._max_size), state["priorities"])
+
+
+class Writer:
+    """
+    The legacy reverb writer interface: append() adds a time step,
+    create_item() makes an item of the last num_timesteps time steps;
+    items are inserted to tables in one batch per table when the writer is closed
+    """
+
+    def __init__(self, tables, max_sequence_length):
+        self._tables = tables
+        self._timesteps = collections.deque(maxlen=max_sequence_length)
+        # table name -> list of (item, priority)
+        self._pending = collections.defaultdict(list)
+
+    def append(self, data):
+        self._timesteps.append(data)
+
+    def create_item(self, table, num_timesteps, priority):
+        timesteps = list(self._timesteps)[-num_timesteps:]
+        if num_timesteps == 1:
+            # an item of one time step has no time dimension, as storage.initialize_dataset() samples it
+            item = timesteps[0]
+        else:
+            item = tf.nest.map_structure(lambda *x: np.stack(x), *timesteps)
+        self._pending[table].append((item, priority))
+
+    def flush(self):
+        for table_name, pending in self._pending.items():
+            items, priorities = zip(*pending)
+            self._tables[table_name].insert(tf.nest.map_structure(lambda *x: np.stack(x), *items), priorities)
+        self._pending.clear()
+
+    def close(self):
+        self.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+
+
+class Client:
+    """
+    A reverb.Client like access to tables of a local buffer
+    """
+
+    def __init__(self, server_port):
+        self._tables = SERVERS[server_port]
+
+    def writer(self, max_sequence_length):
+        return Writer(self._tables, max_sequence_length)
+
+    def server_info(self):
+        return {name: table.info() for name, table in self._tables.items()}
+
+    def mutate_priorities(self, table, updates=None, deletes=None):
+        if updates:
+            self._tables[table].mutate_priorities(updates)
+
+    def reset(self, table):
+        self._tables[table].clear()
+
+
+def make_dataset(server_port, table_name, batch_size, dtypes, shapes, sequence_length=None):
+    """
+    Returns a dataset of batches of ReplaySample sampled from a local table;
+    dtypes and shapes are of one time step, items have sequence_length time steps or one if it is None;
+    as in reverb, info of an item is repeated for every time step, so info fields are [batch, sequence_length]
+    """
+    table = SERVERS[server_port][table_name]
+    prefix = [batch_size] if sequence_length is None else [batch_size, sequence_length]
+    data_signature = tf.nest.map_structure(lambda dtype, shape: tf.TensorSpec(prefix + shape.as_list(), dtype),
+                                           dtypes, shapes)
+    signature = ReplaySample(info=SampleInfo(key=tf.TensorSpec(prefix, tf.uint64),
+                                             probability=tf.TensorSpec(prefix, tf.float64),
+                                             table_size=tf.TensorSpec(prefix, tf.int64),
+                                             priority=tf.TensorSpec(prefix, tf.float64)),
+                             data=data_signature)
+    numpy_dtypes = tf.nest.map_structure(lambda spec: spec.dtype.as_numpy_dtype, data_signature)
+
+    def generate():
+        while True:
+            items, info = table.sample(batch_size)
+            # items keep dtypes they were written with
+            items = tf.nest.map_structure(lambda x, dtype: x.astype(dtype, copy=False), items, numpy_dtypes)
+            if sequence_length is not None:
+                info = SampleInfo(*(np.repeat(x[:, None], sequence_length, axis=1) for x in info))
+            yield ReplaySample(info=info, data=items)
+
+    return tf.data.Dataset.from_generator(generate, output_signature=signature)
+
+
+class _Buffer:
+
+    def __init__(self, table, checkpoint_path=None):
+        self._table = table
+        self._port = next(_ports)
+        self._checkpoint_path = checkpoint_path
+        SERVERS[self._port] = {table.name: table}
+        if checkpoint_path and os.path.exists(self._snapshot_path()):
+            with open(self._snapshot_path(), 'rb') as f:
+                table.restore(pickle.load(f))
+
+    def _snapshot_path(self):
+        return os.path.join(self._checkpoint_path, f"{self._table.name}.pickle")
+
+    @property
+    def table_name(self) -> str:
+        return self._table.name
+
+    @property
+    def min_size(self) -> int:
+        return self._min_size
+
+    @property
+    def server_port(self) -> int:
+        return self._port
+
+    def checkpoint(self) -> str:
+        """
+        Writes a snapshot of the table to checkpoint_path, returns a path of the snapshot
+        """
+        os.makedirs(self._checkpoint_path, exist_ok=True)
+        with open(self._snapshot_path(), 'wb') as f:
+            pickle.dump(self._table.state(), f, pickle.HIGHEST_PROTOCOL)
+        return self._snapshot_path()
+
+    def close(self):
+        SERVERS.pop(self._port, None)
+
+
+class UniformBuffer(_Buffer):
+    """
+    If checkpoint_path is set, a table is restored from a snapshot in it on start
+    and checkpoint() writes a new snapshot there
+    """
+
+    def __init__(self,
+                 min_size: int = 64,
+                 max_size: int = 40000,
+                 checkpoint_path: str = None):
+        self._min_size = min_size
+        super().__init__(Table('uniform_table', max_size, min_size), checkpoint_path)
+
+
+class PriorityBuffer(_Buffer):
+    """
+    If checkpoint_path is set, a table is restored from a snapshot in it on start
+    and checkpoint() writes a new snapshot there
+    """
+
+    def __init__(self,
+                 min_size: int = 64,
+                 max_size: int = 40000,
+                 checkpoint_path: str = None):
+        self._min_size = min_size
+        super().__init__(Table('priority_table', max_size, min_size, priority_exponent=0.8), checkpoint_path)
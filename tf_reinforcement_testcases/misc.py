@@ -1,7 +1,4 @@
 import tensorflow as tf
-import matplotlib as mpl
-import matplotlib.pyplot as plt
-import ray
 
 
 # def project_distribution is from (https://github.com/google/dopamine):
@@ -166,6 +163,51 @@ def project_distribution(supports, weights, target_support,
         return projection
 
 
+def project_distribution_linear(supports, weights, target_support):
+    """Projects a batch of (support, weights) onto target_support as project_distribution does,
+  but without [batch_size, num_dims, num_dims] intermediate tensors.
+  The mass of every clipped atom is split between its floor and ceil neighbours
+  on target_support and summed with a segment sum, so memory and FLOPs are
+  O(batch_size * num_dims).
+  Args:
+    supports: Tensor of shape (batch_size, num_dims) defining supports for the
+      distribution.
+    weights: Tensor of shape (batch_size, num_dims) defining weights on the
+      original support points.
+    target_support: Tensor of shape (num_dims) defining support of the projected
+      distribution. The values must be monotonically increasing and equally spaced.
+  Returns:
+    A Tensor of shape (batch_size, num_dims) with the projection of a batch of
+    (support, weights) onto target_support.
+  """
+    supports.shape.assert_is_compatible_with(weights.shape)
+    target_support.shape.assert_has_rank(1)
+
+    v_min, v_max = target_support[0], target_support[-1]
+    delta_z = target_support[1] - target_support[0]
+    batch_size = tf.shape(supports)[0]
+    num_dims = tf.shape(target_support)[0]
+    # positions of clipped atoms measured in target_support indices, e.g. 2.3 is between z_2 and z_3
+    positions = (tf.clip_by_value(supports, v_min, v_max) - v_min) / delta_z
+    floor_positions = tf.floor(positions)
+    # a share of mass which goes to the ceil neighbour, it is `1 - |positions - ceil|` from Eq7
+    ceil_shares = positions - floor_positions
+    # clipping guards against float errors at v_max, the ceil share is ~0 there
+    floor_ids = tf.clip_by_value(tf.cast(floor_positions, tf.int32), 0, num_dims - 1)
+    ceil_ids = tf.minimum(floor_ids + 1, num_dims - 1)
+    # flatten (batch, atom) pairs to segment ids
+    offsets = tf.range(batch_size)[:, None] * num_dims
+    segment_ids = tf.concat([floor_ids + offsets, ceil_ids + offsets], axis=1)
+    masses = tf.concat([weights * (1. - ceil_shares), weights * ceil_shares], axis=1)
+    projection = tf.math.unsorted_segment_sum(masses, segment_ids, batch_size * num_dims)
+    projection = tf.reshape(projection, [batch_size, num_dims])
+    return projection
+
+
+PROJECTIONS = {"tiled": project_distribution,
+               "linear": project_distribution_linear}
+
+
 # @ray.remote(num_gpus=1)
 def use_gpu():
     """
@@ -173,10 +215,16 @@ def use_gpu():
     ray.init()
     use_gpu.remote()
     """
+    # ray and matplotlib are imported where they are used to not slow down an import of misc in every actor
+    import ray
+
     print("ray.get_gpu_ids(): {}".format(ray.get_gpu_ids()))
 
 
 def plot_2d_array(array, name):
+    import matplotlib as mpl
+    import matplotlib.pyplot as plt
+
     fig = plt.figure(1)
     # make a color map of fixed colors
     # cmap = mpl.colors.ListedColormap(['blue', 'black', 'red'])
@@ -1,9 +1,15 @@
 # move all imports inside functions to use ray.remote multitasking
 
-def get_mlp(input_shape, n_outputs):
+def get_mlp(input_shape, n_outputs, hidden_units=None, dtype=None):
+    """
+    hidden_units are sizes of hidden layers, (500, 500) by default; pruned models are smaller, see prune_mlp().
+    dtype is a keras dtype policy of hidden layers, e.g. 'mixed_bfloat16', None uses the global policy;
+    other model makers take it too.
+    """
     from tensorflow import keras
     import tensorflow.keras.layers as layers
 
+    hidden_units = hidden_units or (500, 500)
     inputs = layers.Input(shape=input_shape)
 
     # x = layers.Dense(500, kernel_initializer="he_normal")(inputs)
@@ -11,124 +17,218 @@ def get_mlp(input_shape, n_outputs):
     # x = layers.Dense(500, kernel_initializer="he_normal")(x)
     # x = layers.LeakyReLU(alpha=0.2)(x)
 
-    x = layers.Dense(500, kernel_initializer="he_normal",
-                     kernel_regularizer=keras.regularizers.l2(0.01),
-                     use_bias=False)(inputs)
-    x = layers.BatchNormalization()(x)
-    x = layers.ELU()(x)
-
-    x = layers.Dense(500, kernel_initializer="he_normal",
-                     kernel_regularizer=keras.regularizers.l2(0.01),
-                     use_bias=False)(x)
-    x = layers.BatchNormalization()(x)
-    x = layers.ELU()(x)
+    x = inputs
+    for units in hidden_units:
+        x = layers.Dense(units, kernel_initializer="he_normal",
+                         kernel_regularizer=keras.regularizers.l2(0.01),
+                         use_bias=False, dtype=dtype)(x)
+        x = layers.BatchNormalization(dtype=dtype)(x)
+        x = layers.ELU(dtype=dtype)(x)
 
     # x = layers.Dense(50, activation="relu")(inputs)
     # x = layers.Dense(10, activation="relu")(x)
 
-    outputs = layers.Dense(n_outputs)(x)
+    # outputs are float32 with a mixed precision policy too
+    outputs = layers.Dense(n_outputs, dtype="float32")(x)
     model = keras.Model(inputs=[inputs], outputs=[outputs])
     return model
 
 
-def get_actor_critic(input_shape, n_outputs):
+def get_actor_critic(input_shape, n_outputs, dtype=None):
     from tensorflow import keras
     import tensorflow.keras.layers as layers
 
-    x = get_mlp(input_shape, 10)
+    x = get_mlp(input_shape, 10, dtype=dtype)
 
     inputs = layers.Input(shape=input_shape)
     x = x(inputs)
-    x = layers.Activation("relu")(x)
-    logits = layers.Dense(n_outputs)(x)  # are not normalized logs
-    q_values = layers.Dense(n_outputs)(x)
+    x = layers.Activation("relu", dtype=dtype)(x)
+    logits = layers.Dense(n_outputs, dtype="float32")(x)  # are not normalized logs
+    q_values = layers.Dense(n_outputs, dtype="float32")(x)
     model = keras.Model(inputs=[inputs], outputs=[logits, q_values])
     return model
 
 
-def get_dueling_q_mlp(input_shape, n_outputs):
+def get_dueling_q_mlp(input_shape, n_outputs, dtype=None):
     import tensorflow as tf
     from tensorflow import keras
     import tensorflow.keras.layers as layers
 
     inputs = layers.Input(shape=input_shape)
-    x = layers.Dense(100, activation="relu")(inputs)
-    state_values = layers.Dense(1)(x)
-    raw_advantages = layers.Dense(n_outputs)(x)
+    x = layers.Dense(100, activation="relu", dtype=dtype)(inputs)
+    state_values = layers.Dense(1, dtype="float32")(x)
+    raw_advantages = layers.Dense(n_outputs, dtype="float32")(x)
     advantages = raw_advantages - tf.reduce_max(raw_advantages, axis=1, keepdims=True)
     Q_values = state_values + advantages
     model = keras.Model(inputs=[inputs], outputs=[Q_values])
     return model
 
 
-def get_sparse(weights_in, mask_in):
+def prune_mlp(data, batch_norm_epsilon=1e-3):
+    """
+    Removes dead hidden neurons of a get_mlp() model from data (weights, mask, reward):
+    a neuron without unmasked outgoing connections is dropped, as in a sparse model of the mask;
+    a neuron with all incoming weights exactly zero outputs a constant, which is added to the next layer
+    (to a moving mean of its batch normalization or to the output bias) before the neuron is dropped.
+    Masked but nonzero incoming weights keep a neuron alive: batch normalization rescales small inputs,
+    so such a neuron does not output a constant.
+    batch_norm_epsilon is the one of keras BatchNormalization.
+    Returns new data with smaller weights and mask and 'hidden_units' to make a model with get_mlp().
+    Raises ValueError if weights are not of a get_mlp() model, e.g. of actor-critic or dueling agents.
+    """
+    import numpy as np
+
+    weights = [np.array(item) for item in data['weights']]
+    mask = [np.array(item) for item in data['mask']]
+    # get_mlp() weights: (kernel, gamma, beta, moving_mean, moving_variance) of every hidden layer,
+    # then an output kernel and bias
+    n_hidden = (len(weights) - 2) // 5
+    kernel_ids = [5 * layer for layer in range(n_hidden + 1)]
+    if not _is_mlp_weights(weights):
+        raise ValueError(f"Weights of shapes {[w.shape for w in weights]} are not of a get_mlp() model")
+
+    is_changed = True
+    # dropping neurons of a layer can make neurons of adjacent layers dead, so repeat until nothing is dropped
+    while is_changed:
+        is_changed = False
+        for layer in range(n_hidden):
+            kernel_id, next_kernel_id = kernel_ids[layer], kernel_ids[layer + 1]
+            is_incoming_dead = ~(weights[kernel_id] != 0).any(axis=0)
+            is_outgoing_dead = ~mask[next_kernel_id].astype(bool).any(axis=1)
+            is_dead = is_incoming_dead | is_outgoing_dead
+            if is_dead.all():
+                # keep one neuron to keep a valid model
+                is_dead[0] = False
+            if not is_dead.any():
+                continue
+
+            is_constant = is_incoming_dead & ~is_outgoing_dead & is_dead
+            if is_constant.any():
+                gamma, beta, moving_mean, moving_variance = weights[kernel_id + 1:kernel_id + 5]
+                # inputs of the neurons are zeros
+                normalized = gamma * (-moving_mean) / np.sqrt(moving_variance + batch_norm_epsilon) + beta
+                outputs = np.where(normalized > 0, normalized, np.expm1(np.minimum(normalized, 0)))  # elu
+                shift = outputs[is_constant] @ weights[next_kernel_id][is_constant]
+                if layer == n_hidden - 1:
+                    weights[next_kernel_id + 1] += shift  # output bias
+                else:
+                    weights[next_kernel_id + 3] -= shift  # moving mean of the next batch normalization
+
+            is_kept = ~is_dead
+            for arrays in (weights, mask):
+                arrays[kernel_id] = arrays[kernel_id][:, is_kept]
+                for i in range(kernel_id + 1, kernel_id + 5):
+                    arrays[i] = arrays[i][is_kept]
+                arrays[next_kernel_id] = arrays[next_kernel_id][is_kept]
+            is_changed = True
+
+    pruned = dict(data)
+    pruned['weights'] = weights
+    pruned['mask'] = mask
+    pruned['hidden_units'] = [weights[kernel_id].shape[1] for kernel_id in kernel_ids[:-1]]
+    return pruned
+
+
+def _is_mlp_weights(weights):
+    n_hidden, remainder = divmod(len(weights) - 2, 5)
+    if n_hidden < 1 or remainder:
+        return False
+    n_inputs = None
+    for layer in range(n_hidden):
+        kernel, *batch_norm = weights[5 * layer:5 * layer + 5]
+        if kernel.ndim != 2 or n_inputs not in (None, kernel.shape[0]):
+            return False
+        if any(item.shape != (kernel.shape[1],) for item in batch_norm):
+            return False
+        n_inputs = kernel.shape[1]
+    kernel, bias = weights[-2:]
+    return kernel.ndim == 2 and kernel.shape[0] == n_inputs and bias.shape == (kernel.shape[1],)
+
+
+def reinitialize(model):
+    """
+    Assigns new initial values to weights of Dense and BatchNormalization layers of a model in place;
+    random initializers are made anew from their configs with new seeds, since an initializer object
+    returns the same values on every call
+    """
+    import numpy as np
+
+    for layer in model.layers:
+        # nested models, e.g. an MLP of an actor-critic model
+        if hasattr(layer, "layers"):
+            reinitialize(layer)
+        for name in ("kernel", "bias", "gamma", "beta", "moving_mean", "moving_variance"):
+            variable = getattr(layer, name, None)
+            initializer = getattr(layer, f"{name}_initializer", None)
+            if variable is None or initializer is None:
+                continue
+            config = initializer.get_config()
+            if "seed" in config:
+                config["seed"] = int(np.random.randint(2 ** 31 - 1))
+                initializer = type(initializer).from_config(config)
+            variable.assign(initializer(variable.shape, variable.dtype))
+
+
+def get_sparse(weights_in, mask_in, sparse_matmul=False, dtype=None):
+    """
+    Makes an MLP from pairs of (weights, biases) with fixed masks of connections.
+    Every layer runs as one op: either a dense matmul with a masked kernel (default)
+    or, if sparse_matmul, a sparse-dense matmul with only unmasked weights stored (COO);
+    the latter pays off only for very sparse masks.
+    """
     from abc import ABC
 
     import numpy as np
     import tensorflow as tf
     from tensorflow import keras
 
-    class SparseSublayer(keras.layers.Layer):
-        def __init__(self, w_init):
-            super(SparseSublayer, self).__init__()
-            self._w = tf.Variable(initial_value=w_init, trainable=True, dtype=tf.float32)
-
-        def call(self, inputs, **kwargs):
-            return tf.matmul(inputs, self._w)
-
     class SparseLayer(keras.layers.Layer):
         def __init__(self, w_init, b_init, mask):
-            super(SparseLayer, self).__init__()
+            super(SparseLayer, self).__init__(dtype=dtype)
             # w size is (input_dimensions, units)
+            float_mask = mask.astype(np.float32)
+            self._mask = tf.constant(float_mask, dtype=tf.float32)
+            # masked weights are zeros and stay zeros since their gradients are masked too
+            self._w = self.add_weight(name="kernel", shape=w_init.shape, trainable=True,
+                                      initializer=keras.initializers.Constant(w_init * float_mask))
+            self._b = self.add_weight(name="bias", shape=b_init.shape, trainable=True,
+                                      initializer=keras.initializers.Constant(b_init))
 
-            bool_mask = mask.astype(np.bool)
-            self._w = []
-            self._mask = []
-            self._num_connections = []
-            num_neurons = self._num_neurons = w_init.shape[-1]
-            for i in range(num_neurons):
-                weights = w_init[:, i]
-                masked_weights = weights[bool_mask[:, i]]
-                # making a column vector, it is necessary for tf matrix multiplication
-                masked_weights_column = masked_weights[..., None]
-                # self._w.append(tf.Variable(initial_value=masked_weights_column, trainable=True, dtype=tf.float32))
-                self._w.append(SparseSublayer(masked_weights_column))
-                self._mask.append(tf.constant(bool_mask[:, i], dtype=tf.bool))
-                self._num_connections.append(tf.constant(np.sum(mask[:, i]).astype(np.int32), dtype=tf.int32))
-
-            self._b = tf.Variable(initial_value=b_init, trainable=True, dtype=tf.float32)
+        def call(self, inputs, **kwargs):
+            # inputs and weights are in a compute dtype of a mixed precision policy if it is set
+            return tf.matmul(inputs, self._w * tf.cast(self._mask, inputs.dtype)) + self._b
+
+    class SparseCOOLayer(keras.layers.Layer):
+        def __init__(self, w_init, b_init, mask):
+            # sparse matmul is computed in float32 with any mixed precision policy
+            super(SparseCOOLayer, self).__init__(dtype="float32")
+            # store a transposed kernel (units, input_dimensions) to multiply it by transposed inputs
+            units_ids, inputs_ids = np.nonzero(mask.T)
+            self._indices = tf.constant(np.stack([units_ids, inputs_ids], axis=1), dtype=tf.int64)
+            self._dense_shape = tf.constant(mask.T.shape, dtype=tf.int64)
+            self._w = self.add_weight(name="kernel_values", shape=units_ids.shape, trainable=True,
+                                      initializer=keras.initializers.Constant(w_init.T[units_ids, inputs_ids]))
+            self._b = self.add_weight(name="bias", shape=b_init.shape, trainable=True,
+                                      initializer=keras.initializers.Constant(b_init))
 
         def call(self, inputs, **kwargs):
-            neurons = []
-            for i in range(self._num_neurons):
-                # reshape mask to (batch_size x inputs_size)
-                mask = tf.broadcast_to(self._mask[i], [inputs.shape[0], self._mask[i].shape[0]])
-                # mask inputs
-                masked_inputs = tf.boolean_mask(inputs, mask)
-                # restore dimensions after masking
-                # reshaped_masked_inputs = tf.reshape(
-                #     masked_inputs, [inputs.shape[0], tf.reduce_sum(tf.cast(self._mask[i], tf.int32)).numpy()])
-                reshaped_masked_inputs = tf.reshape(masked_inputs, [inputs.shape[0], self._num_connections[i]])
-                # matrix multiplication for one neuron
-                # neuron = tf.matmul(reshaped_masked_inputs, self._w[i]) + self._b[i]
-                neuron = self._w[i](reshaped_masked_inputs) + self._b[i]
-                neurons.append(neuron)
-
-            result = tf.stack([*neurons], axis=1)
-            result = result[..., 0]  # all except the last dimension
-            return result
+            kernel = tf.SparseTensor(self._indices, self._w, self._dense_shape)
+            # (units, input_dimensions) x (batch_size, input_dimensions)^T = (units, batch_size)
+            outputs = tf.sparse.sparse_dense_matmul(kernel, inputs, adjoint_b=True)
+            return tf.transpose(outputs) + self._b
 
     class SparseMLP(keras.Model, ABC):
         def __init__(self, weights, mask):
-            super(SparseMLP, self).__init__()
+            super(SparseMLP, self).__init__(dtype=dtype)
 
+            layer_object = SparseCOOLayer if sparse_matmul else SparseLayer
             number_of_layers = int(len(weights) / 2)
             self._main_layers = []
             for i in range(0, number_of_layers):
-                self._main_layers.append(SparseLayer(weights[i * 2], weights[i * 2 + 1], mask[i * 2]))
+                self._main_layers.append(layer_object(weights[i * 2], weights[i * 2 + 1], mask[i * 2]))
                 # do not add activation on the last layer
                 if i != number_of_layers - 1:
-                    self._main_layers.append(keras.layers.Activation("relu"))
+                    self._main_layers.append(keras.layers.Activation("relu", dtype=dtype))
 
         def call(self, inputs, **kwargs):
             if type(inputs) is tuple:
@@ -138,7 +238,7 @@ def get_sparse(weights_in, mask_in):
 
             for layer in self._main_layers:
                 Z = layer(Z)
-            return Z
+            return tf.cast(Z, tf.float32)
 
     model = SparseMLP(weights_in, mask_in)
     return model
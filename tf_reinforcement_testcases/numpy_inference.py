@@ -0,0 +1,252 @@
+"""
+Forward passes of models from models.py with numpy only, e.g. for collectors, which do not import tensorflow:
+export_*() functions turn a keras model into a NumpyModel of dense layers with batch normalization folded in,
+NumpyPolicy chooses epsilon greedy actions with it, save() and load_policy() keep a policy in a npz file.
+Exporting needs a keras model, running and loading need numpy only.
+"""
+import json
+
+import numpy as np
+
+ACTIVATIONS = {"linear": lambda x: x,
+               "relu": lambda x: np.maximum(x, 0.),
+               "elu": lambda x: np.where(x > 0., x, np.expm1(np.minimum(x, 0.))),
+               "tanh": np.tanh,
+               "sigmoid": lambda x: 1. / (1. + np.exp(-x))}
+
+
+class Dense:
+    """
+    activation(inputs @ kernel + bias); a quantized kernel is int8 with a float32 scale per output unit
+    """
+
+    def __init__(self, kernel, bias, activation="linear", scale=None):
+        self.kernel = kernel
+        self.bias = bias
+        self.activation = activation
+        self.scale = scale
+
+    def __call__(self, inputs):
+        if self.scale is None:
+            outputs = inputs @ self.kernel
+        else:
+            outputs = (inputs @ self.kernel.astype(np.float32)) * self.scale
+        return ACTIVATIONS[self.activation](outputs + self.bias)
+
+    def quantize(self):
+        """
+        Returns a copy with a symmetric per output unit int8 kernel
+        """
+        if self.scale is not None:
+            return self
+        scale = np.abs(self.kernel).max(axis=0) / 127.
+        scale = np.where(scale > 0., scale, 1.).astype(np.float32)
+        kernel = np.round(self.kernel / scale).astype(np.int8)
+        return Dense(kernel, self.bias, self.activation, scale)
+
+
+class NumpyModel:
+    """
+    Dense layers of a trunk followed by dense heads on the trunk output:
+    one head gives one output, several heads give a tuple of outputs,
+    'dueling' combines a value head and an advantage head into Q values as in models.get_dueling_q_mlp()
+    """
+
+    def __init__(self, trunk, heads, combine=None):
+        self.trunk = trunk
+        self.heads = heads
+        self.combine = combine
+
+    def __call__(self, inputs):
+        x = np.asarray(inputs, dtype=np.float32)
+        for layer in self.trunk:
+            x = layer(x)
+        outputs = [head(x) for head in self.heads]
+        if self.combine == "dueling":
+            state_values, raw_advantages = outputs
+            return state_values + raw_advantages - raw_advantages.max(axis=1, keepdims=True)
+        return outputs[0] if len(outputs) == 1 else tuple(outputs)
+
+    def quantize(self):
+        return NumpyModel([layer.quantize() for layer in self.trunk],
+                          [head.quantize() for head in self.heads],
+                          self.combine)
+
+
+def _value(variable):
+    return np.asarray(variable, dtype=np.float32)
+
+
+def _activation_name(layer):
+    class_name = type(layer).__name__
+    if class_name in ("ELU", "ReLU"):
+        return class_name.lower()
+    activation = layer.get_config()["activation"]
+    if activation not in ACTIVATIONS:
+        raise ValueError(f"Activation {activation} is not supported")
+    return activation
+
+
+def _flatten_layers(model):
+    for layer in model.layers:
+        # a nested model, e.g. an MLP of an actor-critic model
+        if hasattr(layer, "layers"):
+            yield from _flatten_layers(layer)
+        else:
+            yield layer
+
+
+def _dense_chain(model):
+    """
+    Returns Dense layers of a model in order with batch normalizations and activation layers
+    merged into preceding dense layers; layers without weights, e.g. tf ops, are skipped
+    """
+    chain = []
+    for layer in _flatten_layers(model):
+        class_name = type(layer).__name__
+        if class_name == "Dense":
+            kernel = _value(layer.kernel)
+            bias = _value(layer.bias) if layer.bias is not None else np.zeros(kernel.shape[1], np.float32)
+            chain.append(Dense(kernel, bias, _activation_name(layer)))
+        elif class_name == "BatchNormalization":
+            # gamma * (x - moving_mean) / sqrt(moving_variance + epsilon) + beta of inference
+            dense = chain[-1]
+            scale = 1. / np.sqrt(_value(layer.moving_variance) + layer.epsilon)
+            if layer.gamma is not None:
+                scale = scale * _value(layer.gamma)
+            shift = -_value(layer.moving_mean) * scale
+            if layer.beta is not None:
+                shift = shift + _value(layer.beta)
+            dense.kernel = (dense.kernel * scale).astype(np.float32)
+            dense.bias = (dense.bias * scale + shift).astype(np.float32)
+        elif class_name in ("ELU", "ReLU", "Activation"):
+            chain[-1].activation = _activation_name(layer)
+    return chain
+
+
+def export_mlp(model):
+    """
+    Exports a model of models.get_mlp()
+    """
+    chain = _dense_chain(model)
+    return NumpyModel(chain[:-1], chain[-1:])
+
+
+def export_actor_critic(model):
+    """
+    Exports a model of models.get_actor_critic(), it outputs (logits, Q values)
+    """
+    chain = _dense_chain(model)
+    return NumpyModel(chain[:-2], chain[-2:])
+
+
+def export_dueling_q_mlp(model):
+    """
+    Exports a model of models.get_dueling_q_mlp()
+    """
+    chain = _dense_chain(model)
+    # a state value head has one unit
+    value_head, advantage_head = sorted(chain[-2:], key=lambda head: head.kernel.shape[1])
+    return NumpyModel(chain[:-2], [value_head, advantage_head], combine="dueling")
+
+
+def export_sparse(model):
+    """
+    Exports a model of models.get_sparse(), masked kernels are stored dense
+    """
+    chain = []
+    for layer in model._main_layers:
+        class_name = type(layer).__name__
+        if class_name == "SparseLayer":
+            chain.append(Dense(_value(layer._w) * _value(layer._mask), _value(layer._b)))
+        elif class_name == "SparseCOOLayer":
+            # values are stored for a transposed kernel (units, input_dimensions)
+            kernel = np.zeros(np.asarray(layer._dense_shape), dtype=np.float32)
+            units_ids, inputs_ids = np.asarray(layer._indices).T
+            kernel[units_ids, inputs_ids] = _value(layer._w)
+            chain.append(Dense(kernel.T.copy(), _value(layer._b)))
+        else:
+            chain[-1].activation = _activation_name(layer)
+    return NumpyModel(chain[:-1], chain[-1:])
+
+
+def _softmax(x):
+    exponents = np.exp(x - x.max(axis=-1, keepdims=True))
+    return exponents / exponents.sum(axis=-1, keepdims=True)
+
+
+class NumpyPolicy:
+    """
+    Epsilon greedy actions of a NumpyModel.
+    Actions maximize Q values, expectations of Q value distributions over support if it is set
+    (categorical agents), or logits if a model outputs (logits, Q values) (actor-critic agents).
+    """
+
+    def __init__(self, model, n_outputs, support=None):
+        self.model = model
+        self.n_outputs = n_outputs
+        self.support = None if support is None else np.asarray(support, dtype=np.float32)
+
+    def action_values(self, observations):
+        predictions = self.model(observations)
+        if isinstance(predictions, tuple):
+            logits, _ = predictions
+            return logits
+        if self.support is not None:
+            logits = predictions.reshape(-1, self.n_outputs, len(self.support))
+            return (_softmax(logits) * self.support).sum(axis=-1)
+        return predictions
+
+    def __call__(self, observations, epsilon=0.):
+        """
+        Returns actions for a batch of observations
+        """
+        greedy_actions = self.action_values(observations).argmax(axis=-1)
+        if epsilon <= 0:
+            return greedy_actions
+        random_actions = np.random.randint(self.n_outputs, size=len(greedy_actions))
+        return np.where(np.random.rand(len(greedy_actions)) < epsilon, random_actions, greedy_actions)
+
+    def act(self, obs, epsilon=0.):
+        """
+        Returns an action for one observation
+        """
+        if np.random.rand() < epsilon:
+            return np.random.randint(self.n_outputs)
+        return int(self(np.asarray(obs, dtype=np.float32)[None, ...])[0])
+
+    def save(self, path):
+        """
+        Writes the policy to a npz file
+        """
+        arrays = {}
+        layers = []
+        for part in ("trunk", "heads"):
+            for i, layer in enumerate(getattr(self.model, part)):
+                name = f"{part}_{i}"
+                arrays[f"{name}_kernel"] = layer.kernel
+                arrays[f"{name}_bias"] = layer.bias
+                if layer.scale is not None:
+                    arrays[f"{name}_scale"] = layer.scale
+                layers.append({"part": part, "name": name, "activation": layer.activation,
+                               "quantized": layer.scale is not None})
+        if self.support is not None:
+            arrays["support"] = self.support
+        meta = {"layers": layers, "combine": self.model.combine, "n_outputs": self.n_outputs}
+        np.savez(path, meta=np.array(json.dumps(meta)), **arrays)
+
+
+def load_policy(path):
+    """
+    Reads a policy written by NumpyPolicy.save()
+    """
+    with np.load(path) as arrays:
+        meta = json.loads(str(arrays["meta"]))
+        parts = {"trunk": [], "heads": []}
+        for layer in meta["layers"]:
+            name = layer["name"]
+            scale = arrays[f"{name}_scale"] if layer["quantized"] else None
+            parts[layer["part"]].append(Dense(arrays[f"{name}_kernel"], arrays[f"{name}_bias"],
+                                              layer["activation"], scale))
+        support = arrays["support"] if "support" in arrays else None
+    return NumpyPolicy(NumpyModel(parts["trunk"], parts["heads"], meta["combine"]), meta["n_outputs"], support)
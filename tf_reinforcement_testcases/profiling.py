@@ -0,0 +1,95 @@
+import collections
+import contextlib
+import json
+import os
+import resource
+import sys
+import time
+
+import tensorflow as tf
+
+
+def memory_rss():
+    """
+    Returns a current resident set size of the process in bytes
+    """
+    try:
+        with open('/proc/self/statm') as f:
+            pages = int(f.read().split()[1])
+        return pages * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError):
+        # /proc is not available, e.g. on macos; use a peak value instead
+        return peak_memory_rss()
+
+
+def peak_memory_rss():
+    """
+    Returns a peak resident set size of the process in bytes
+    """
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # linux reports kilobytes, macos reports bytes
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+class PhaseTimer:
+    """
+    Accumulates wall time and a number of calls of named phases (e.g. collection, training step) and counters;
+    write() exports them together with process memory to tf.summary (TensorBoard) and
+    to a json lines file phases.jsonl in log_dir, if log_dir is set
+    """
+
+    def __init__(self, log_dir=None):
+        self._times = collections.defaultdict(float)
+        self._calls = collections.defaultdict(int)
+        self._counters = collections.defaultdict(int)
+        self._start_time = time.perf_counter()
+        self._summary_writer = None
+        self._log_file = None
+        if log_dir:
+            os.makedirs(log_dir, exist_ok=True)
+            self._summary_writer = tf.summary.create_file_writer(log_dir)
+            self._log_file = open(os.path.join(log_dir, 'phases.jsonl'), 'a')
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            self._times[name] += time.perf_counter() - start_time
+            self._calls[name] += 1
+
+    def count(self, name, value=1):
+        self._counters[name] += value
+
+    def time(self, name):
+        return self._times[name]
+
+    def elapsed(self):
+        return time.perf_counter() - self._start_time
+
+    def summary(self):
+        return {"elapsed": self.elapsed(),
+                "rss": memory_rss(),
+                "peak_rss": peak_memory_rss(),
+                "times": dict(self._times),
+                "calls": dict(self._calls),
+                "counters": dict(self._counters)}
+
+    def write(self, step):
+        record = self.summary()
+        record["step"] = step
+        if self._summary_writer:
+            with self._summary_writer.as_default():
+                tf.summary.scalar("memory/rss", record["rss"], step=step)
+                tf.summary.scalar("memory/peak_rss", record["peak_rss"], step=step)
+                for name, value in record["times"].items():
+                    tf.summary.scalar(f"time/{name}", value, step=step)
+                    tf.summary.scalar(f"time_fraction/{name}", value / record["elapsed"], step=step)
+                for name, value in record["counters"].items():
+                    tf.summary.scalar(f"counters/{name}", value, step=step)
+            self._summary_writer.flush()
+        if self._log_file:
+            self._log_file.write(json.dumps(record) + "\n")
+            self._log_file.flush()
+        return record
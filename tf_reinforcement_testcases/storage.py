@@ -1,11 +1,91 @@
+import queue
+import threading
+import time
+
+import numpy as np
 import tensorflow as tf
 
 import reverb
 
+from tf_reinforcement_testcases import local_buffer
+
+
+def observation_dtypes(observation_space, float_dtype=tf.float32):
+    """
+    Returns the smallest dtypes to store observations of the space without loss:
+    integer and boolean components are stored as uint8, int8, int16 or int32 depending on their bounds,
+    float components as float_dtype (float16 halves memory, but is lossy);
+    a space with several components (e.g. gym.spaces.Tuple) gives a tuple of dtypes
+    """
+    if isinstance(getattr(observation_space, 'spaces', None), (tuple, list)):
+        return tuple(observation_dtypes(space, float_dtype) for space in observation_space.spaces)
+
+    dtype = np.dtype(observation_space.dtype)
+    if dtype == np.bool_:
+        return tf.uint8
+    if np.issubdtype(dtype, np.integer):
+        low, high = _integer_bounds(observation_space)
+        for candidate in (np.uint8, np.int8, np.int16, np.int32):
+            if np.iinfo(candidate).min <= low and high <= np.iinfo(candidate).max:
+                return tf.as_dtype(candidate)
+    return float_dtype
+
+
+def _integer_bounds(observation_space):
+    """
+    Returns (low, high) of values of an integer space: Box has bounds, MultiDiscrete has nvec,
+    MultiBinary has 0 and 1, Discrete has start and n; other spaces are bounded by their dtype
+    """
+    if hasattr(observation_space, 'low') and hasattr(observation_space, 'high'):
+        return np.min(observation_space.low), np.max(observation_space.high)
+    if hasattr(observation_space, 'nvec'):
+        return 0, np.max(observation_space.nvec) - 1
+    # MultiBinary has n too, a number of its elements
+    if type(observation_space).__name__ == 'MultiBinary':
+        return 0, 1
+    if hasattr(observation_space, 'n'):
+        start = getattr(observation_space, 'start', 0)
+        return start, start + observation_space.n - 1
+    info = np.iinfo(np.dtype(observation_space.dtype))
+    return info.min, info.max
+
+
+def _match_dtypes(dtypes, structure):
+    """
+    Makes a structure of dtypes like the given structure, a single dtype (or None for float32) is used for all
+    """
+    if dtypes is None or isinstance(dtypes, tf.DType):
+        return tf.nest.map_structure(lambda x: dtypes or tf.float32, structure)
+    return dtypes
+
 
-def initialize_dataset(server_port, table_name, observations_shape, batch_size, n_steps):
+def make_client(server_port):
     """
-    batch_size in fact equals min size of a buffer
+    Returns a client of a reverb server or of an in-process local_buffer, which registered the port
+    """
+    if local_buffer.is_local(server_port):
+        return local_buffer.Client(server_port)
+    return reverb.Client(f'localhost:{server_port}')
+
+
+def initialize_dataset(server_port, table_name, observations_shape, batch_size, n_steps,
+                       precompute_returns=False, obs_dtypes=None,
+                       num_parallel_calls=1, max_in_flight_samples_per_worker=10, num_workers_per_iterator=-1,
+                       prefetch=tf.data.experimental.AUTOTUNE):
+    """
+    batch_size in fact equals min size of a buffer;
+    items are n_steps time steps: data and sample info fields have shapes [batch_size, n_steps, ...],
+    info is the same for all time steps of an item;
+    if precompute_returns, items are single time steps made by EpisodeBuffer.write_n_step(),
+    data and info have shapes [batch_size, ...];
+    obs_dtypes are dtypes observations are stored with (see observation_dtypes()),
+    sampled observations are always converted to float32.
+    Sampling is tuned with:
+    num_parallel_calls - a number of replay datasets sampled in parallel and interleaved,
+    max_in_flight_samples_per_worker, num_workers_per_iterator - see reverb.ReplayDataset,
+    prefetch - a number of batches prepared in advance (autotuned by default, 0 disables prefetching).
+    Use dataset_throughput() to choose them for a given number of cores.
+    Sampling settings are not used by local buffers (see local_buffer), they sample batches in place.
     """
     # if there are many dimensions assume halite
     if len(observations_shape) > 1:
@@ -13,31 +93,262 @@ def initialize_dataset(server_port, table_name, observations_shape, batch_size,
         scalars_shape = tf.TensorShape(observations_shape[1])
         observations_shape = (maps_shape, scalars_shape)
     else:
-        observations_shape = tf.nest.map_structure(lambda x: tf.TensorShape(x), observations_shape)
+        # a flat observation is one array, as EpisodeBuffer stores it
+        observations_shape = tf.TensorShape(observations_shape)
 
     actions_shape = tf.TensorShape([])
     rewards_shape = tf.TensorShape([])
     dones_shape = tf.TensorShape([])
 
-    obs_dtypes = tf.nest.map_structure(lambda x: tf.float32, observations_shape)
+    obs_dtypes = _match_dtypes(obs_dtypes, observations_shape)
+    if precompute_returns:
+        # first and last observations of n_steps time steps
+        observations_shape = (observations_shape, observations_shape)
+        obs_dtypes = (obs_dtypes, obs_dtypes)
 
-    dataset = reverb.ReplayDataset(
-        server_address=f'localhost:{server_port}',
-        table=table_name,
-        max_in_flight_samples_per_worker=10,
-        dtypes=(tf.int32, obs_dtypes, tf.float32, tf.float32),
-        shapes=(actions_shape, observations_shape, rewards_shape, dones_shape))
+    shapes = (actions_shape, observations_shape, rewards_shape, dones_shape)
+    if not precompute_returns:
+        # elements of whole items have a leading sequence dimension
+        replay_shapes = tf.nest.map_structure(tf.TensorShape([n_steps]).concatenate, shapes)
+    else:
+        replay_shapes = shapes
+
+    def make_replay_dataset(_):
+        # every element is a whole item: n_steps time steps or one precomputed time step
+        return reverb.ReplayDataset(
+            server_address=f'localhost:{server_port}',
+            table=table_name,
+            max_in_flight_samples_per_worker=max_in_flight_samples_per_worker,
+            num_workers_per_iterator=num_workers_per_iterator,
+            dtypes=(tf.int32, obs_dtypes, tf.float32, tf.float32),
+            shapes=replay_shapes,
+            sequence_length=1 if precompute_returns else n_steps,
+            emit_timesteps=precompute_returns)
+
+    if local_buffer.is_local(server_port):
+        dataset = local_buffer.make_dataset(server_port, table_name, batch_size,
+                                            dtypes=(tf.int32, obs_dtypes, tf.float32, tf.float32),
+                                            shapes=shapes,
+                                            sequence_length=None if precompute_returns else n_steps)
+    else:
+        if num_parallel_calls > 1:
+            dataset = tf.data.Dataset.range(num_parallel_calls).interleave(
+                make_replay_dataset,
+                cycle_length=num_parallel_calls,
+                num_parallel_calls=num_parallel_calls,
+                deterministic=False)
+        else:
+            dataset = make_replay_dataset(None)
+        dataset = dataset.batch(batch_size, drop_remainder=True)
 
-    dataset = dataset.batch(n_steps)
-    dataset = dataset.batch(batch_size)
+    def decode(sample):
+        action, obs, reward, done = sample.data
+        obs = tf.nest.map_structure(lambda x: tf.cast(x, tf.float32), obs)
+        return sample._replace(data=(action, obs, reward, done))
+
+    dataset = dataset.map(decode, num_parallel_calls=tf.data.experimental.AUTOTUNE)
+    if prefetch:
+        dataset = dataset.prefetch(prefetch)
 
     return dataset
 
 
+def dataset_throughput(dataset, n_batches=100):
+    """
+    Returns a number of items per second the dataset yields, the first batch is not timed
+    """
+    iterator = iter(dataset)
+    sample = next(iterator)
+    batch_size = tf.nest.flatten(sample.data)[0].shape[0]
+    start_time = time.perf_counter()
+    for _ in range(n_batches):
+        next(iterator)
+    return n_batches * batch_size / (time.perf_counter() - start_time)
+
+
+class EpisodeBuffer:
+    """
+    Preallocated numpy arrays for time steps (action, obs, reward, done) of one episode;
+    an episode is sent to a writer when it is finished, so no tensors are made while stepping.
+    Observations are stored with obs_dtypes (float32 by default), see observation_dtypes()
+    """
+
+    def __init__(self, capacity: int = 1000, obs_dtypes=None):
+        self._capacity = capacity
+        self._obs_dtypes = obs_dtypes
+        self._length = 0
+        self._actions = None
+        self._observations = None
+        self._rewards = None
+        self._dones = None
+
+    def _allocate(self, obs):
+        self._actions = np.empty(self._capacity, dtype=np.int32)
+        self._observations = tf.nest.map_structure(
+            lambda x, dtype: np.empty((self._capacity,) + np.shape(x), dtype=dtype.as_numpy_dtype),
+            obs, _match_dtypes(self._obs_dtypes, obs))
+        self._rewards = np.empty(self._capacity, dtype=np.float32)
+        self._dones = np.empty(self._capacity, dtype=np.float32)
+
+    def _grow(self):
+        # double the capacity for episodes longer than expected
+        self._capacity *= 2
+        self._actions = np.resize(self._actions, self._capacity)
+        self._observations = tf.nest.map_structure(
+            lambda x: np.concatenate([x, np.empty_like(x)]), self._observations)
+        self._rewards = np.resize(self._rewards, self._capacity)
+        self._dones = np.resize(self._dones, self._capacity)
+
+    def __len__(self):
+        return self._length
+
+    def reset(self, obs):
+        """
+        Starts a new episode with an initial observation
+        """
+        if self._actions is None:
+            self._allocate(obs)
+        self._length = 0
+        self.append(-1, obs, 0., 0.)
+
+    def append(self, action, obs, reward, done):
+        if self._length == self._capacity:
+            self._grow()
+        i = self._length
+        self._actions[i] = action
+        tf.nest.map_structure(lambda buffer, x: buffer.__setitem__(i, x), self._observations, obs)
+        self._rewards[i] = reward
+        self._dones[i] = done
+        self._length += 1
+
+    def write(self, writer, table_name, n_steps):
+        """
+        Appends all time steps to a writer and creates an item for every n_steps consecutive time steps,
+        returns a number of created items
+        """
+        items_created = 0
+        for i in range(self._length):
+            obs = tf.nest.map_structure(lambda x: x[i], self._observations)
+            writer.append((self._actions[i], obs, self._rewards[i], self._dones[i]))
+            if i >= n_steps - 1:
+                writer.create_item(table=table_name, num_timesteps=n_steps, priority=1.)
+                items_created += 1
+        return items_created
+
+    def write_n_step(self, writer, table_name, n_steps, discount_rate):
+        """
+        Creates an item of one time step for every n_steps consecutive time steps (the same windows as in write());
+        an item is (action, (first obs, last obs), discounted n-step return, last done),
+        where action is the one taken at the first obs.
+        Returns a number of created items.
+        """
+        n_items = self._length - n_steps + 1
+        if n_items <= 0:
+            return 0
+        discounts = discount_rate ** np.arange(n_steps - 1)
+        # returns[t] = sum_k discounts[k] * rewards[t + 1 + k], rewards[0] is a reward prior the first obs
+        returns = np.correlate(self._rewards[1:self._length], discounts, mode='valid').astype(np.float32)
+        for t in range(n_items):
+            first_obs = tf.nest.map_structure(lambda x: x[t], self._observations)
+            last_obs = tf.nest.map_structure(lambda x: x[t + n_steps - 1], self._observations)
+            writer.append((self._actions[t + 1], (first_obs, last_obs), returns[t], self._dones[t + n_steps - 1]))
+            writer.create_item(table=table_name, num_timesteps=1, priority=1.)
+        return n_items
+
+
+class PriorityUpdater:
+    """
+    Sends priority updates to a table from a background thread, so a learner does not wait for a server:
+    put() queues keys and priorities of a batch, the thread merges queued batches into one
+    mutate_priorities call of up to max_batch_size items; a newer priority of a key replaces an older one.
+    flush() waits for queued updates, close() also stops the thread.
+    """
+
+    def __init__(self, client, table_name, max_batch_size=1024):
+        self._client = client
+        self._table_name = table_name
+        self._max_batch_size = max_batch_size
+        self._queue = queue.Queue()
+        self._error = None
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def put(self, keys, priorities):
+        """
+        keys and priorities are vectors of the same length
+        """
+        if self._error is not None:
+            raise self._error
+        keys, priorities = np.asarray(keys), np.asarray(priorities, dtype=np.float64)
+        if keys.ndim != 1 or keys.shape != priorities.shape:
+            raise ValueError(f"Keys and priorities should be vectors of the same length, "
+                             f"got shapes {keys.shape} and {priorities.shape}")
+        self._queue.put((keys, priorities))
+
+    def flush(self):
+        """
+        Waits until all queued updates are sent
+        """
+        self._queue.join()
+        if self._error is not None:
+            raise self._error
+
+    def close(self):
+        """
+        Sends queued updates and stops the thread, put() is not called after it
+        """
+        try:
+            self.flush()
+        finally:
+            self._queue.put(None)
+            self._thread.join()
+
+    def _run(self):
+        while True:
+            batch = self._queue.get()
+            # close() queues None after all updates are sent
+            if batch is None:
+                self._queue.task_done()
+                return
+            batches = [batch]
+            n_items = len(batches[0][0])
+            # merge updates, which are already queued
+            while n_items < self._max_batch_size:
+                try:
+                    batches.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+                n_items += len(batches[-1][0])
+            try:
+                updates = {}
+                for keys, priorities in batches:
+                    updates.update(zip(keys.tolist(), priorities.tolist()))
+                self._client.mutate_priorities(self._table_name, updates=updates)
+            except Exception as error:
+                # e.g. a server is stopped; the error is raised in a learner by the next put() or flush()
+                self._error = error
+            finally:
+                # flush() never waits for a failed update
+                for _ in batches:
+                    self._queue.task_done()
+
+
+def _make_checkpointer(checkpoint_path):
+    if checkpoint_path is None:
+        return None
+    return reverb.checkpointers.DefaultCheckpointer(path=checkpoint_path)
+
+
 class UniformBuffer:
+    """
+    If checkpoint_path is set, a table is restored from the latest snapshot in it on start
+    and checkpoint() writes new snapshots there
+    """
+
     def __init__(self,
                  min_size: int = 64,
-                 max_size: int = 40000):
+                 max_size: int = 40000,
+                 checkpoint_path: str = None):
 
         self._min_size = min_size
         self._table_name = 'uniform_table'
@@ -51,7 +362,8 @@ class UniformBuffer:
                     rate_limiter=reverb.rate_limiters.MinSize(min_size)),
             ],
             # Sets the port to None to make the server pick one automatically.
-            port=None)
+            port=None,
+            checkpointer=_make_checkpointer(checkpoint_path))
 
     @property
     def table_name(self) -> str:
@@ -65,11 +377,23 @@ class UniformBuffer:
     def server_port(self) -> int:
         return self._server.port
 
+    def checkpoint(self) -> str:
+        """
+        Writes a snapshot of the table to checkpoint_path, returns a path of the snapshot
+        """
+        return reverb.Client(f'localhost:{self.server_port}').checkpoint()
+
 
 class PriorityBuffer:
+    """
+    If checkpoint_path is set, a table is restored from the latest snapshot in it on start
+    and checkpoint() writes new snapshots there
+    """
+
     def __init__(self,
                  min_size: int = 64,
-                 max_size: int = 40000):
+                 max_size: int = 40000,
+                 checkpoint_path: str = None):
         self._min_size = min_size
         self._table_name = 'priority_table'
         self._server = reverb.Server(
@@ -82,7 +406,8 @@ class PriorityBuffer:
                     rate_limiter=reverb.rate_limiters.MinSize(min_size)),
             ],
             # Sets the port to None to make the server pick one automatically.
-            port=None)
+            port=None,
+            checkpointer=_make_checkpointer(checkpoint_path))
 
     @property
     def table_name(self) -> str:
@@ -95,3 +420,9 @@ class PriorityBuffer:
     @property
     def server_port(self) -> int:
         return self._server.port
+
+    def checkpoint(self) -> str:
+        """
+        Writes a snapshot of the table to checkpoint_path, returns a path of the snapshot
+        """
+        return reverb.Client(f'localhost:{self.server_port}').checkpoint()
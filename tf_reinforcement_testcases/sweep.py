@@ -0,0 +1,68 @@
+import math
+import random
+
+
+def sample_config(search_space, rng=random):
+    """
+    search_space maps a parameter name to a list of values to choose from
+    or to a (low, high) tuple of a range to sample from log-uniformly, e.g.
+    {"agent_name": ["double", "categorical"], "learning_rate": (1e-4, 1e-2), "batch_size": [32, 64]}
+    """
+    config = {}
+    for name, values in search_space.items():
+        if isinstance(values, tuple):
+            low, high = values
+            config[name] = math.exp(rng.uniform(math.log(low), math.log(high)))
+        else:
+            config[name] = rng.choice(values)
+    return config
+
+
+class ASHAScheduler:
+    """
+    Asynchronous successive halving.
+    Trials are trained in rungs of growing budgets min_budget * reduction_factor ** k up to max_budget;
+    a trial is promoted to the next rung when it is in the top 1 / reduction_factor of trials finished in its rung,
+    so free workers never wait for a whole rung to finish.
+    """
+
+    def __init__(self, min_budget=500, max_budget=4500, reduction_factor=3):
+        self._reduction_factor = reduction_factor
+        n_rungs = int(round(math.log(max_budget / min_budget, reduction_factor))) + 1
+        self._budgets = [min(int(min_budget * reduction_factor ** rung), max_budget) for rung in range(n_rungs)]
+        # rewards of trials finished in every rung, trial id -> reward
+        self._rungs = [{} for _ in self._budgets]
+        self._promoted = [set() for _ in self._budgets]
+
+    @property
+    def budgets(self):
+        return self._budgets
+
+    def report(self, trial_id, rung, reward):
+        self._rungs[rung][trial_id] = reward
+
+    def is_last_rung(self, rung):
+        return rung == len(self._budgets) - 1
+
+    def promotion(self):
+        """
+        Returns (trial id, next rung) of a trial to continue, starting from higher rungs, or None
+        """
+        for rung in reversed(range(len(self._budgets) - 1)):
+            rewards = self._rungs[rung]
+            n_top = len(rewards) // self._reduction_factor
+            for trial_id in sorted(rewards, key=rewards.get, reverse=True)[:n_top]:
+                if trial_id not in self._promoted[rung]:
+                    self._promoted[rung].add(trial_id)
+                    return trial_id, rung + 1
+        return None
+
+    def best(self):
+        """
+        Returns (trial id, reward) of the best trial in the highest rung with finished trials
+        """
+        for rewards in reversed(self._rungs):
+            if rewards:
+                trial_id = max(rewards, key=rewards.get)
+                return trial_id, rewards[trial_id]
+        return None